@@ -1,6 +1,10 @@
-from typing import Tuple
+from typing import Tuple, Union
 from ctypes import Array
 
+from constants import EVENT_WAIT_MODE, DEFAULT_AI_BUFFER_TIME, AUTO_BUFFER_TIME, AI_BUFFER_MIN_TIME, \
+    AI_BUFFER_MAX_SIZE, AI_BUFFER_DEFAULT_LATENCY, AI_BUFFER_LATENCY_FACTOR
+
+import numpy as np
 import uldaq as ul
 import logging
 
@@ -14,13 +18,57 @@ class AiParams:
         self.input_mode = ul.AiInputMode.SINGLE_ENDED  # 2
         self.scan_flags = ul.AInScanFlag.DEFAULT  # 0
         self.options = ul.ScanOption.CONTINUOUS  # 8
+        self.wait_mode = EVENT_WAIT_MODE
+        self.buffer_time: Union[float, str] = DEFAULT_AI_BUFFER_TIME  # s or AUTO_BUFFER_TIME
+
+    def is_scaled(self) -> bool:
+        """Tells if the board returns volts, not raw ADC counts, see AInScanFlag.NOSCALEDATA."""
+        return not self.scan_flags & ul.AInScanFlag.NOSCALEDATA
 
     def __str__(self):
         return str(vars(self))
 
 
+def get_range_limits(range_id: int) -> Tuple[float, float]:
+    """Provides the lowest and the highest voltage of the uldaq.Range, e.g. (-10., 10.) for BIP10VOLTS.
+
+    Raises:
+        ValueError if the range is not a voltage range.
+    """
+    name = ul.Range(range_id).name
+    polarity, span = name[:3], name[3:]
+    if polarity not in ('BIP', 'UNI') or not span.endswith('VOLTS'):
+        raise ValueError("'{}' is not a voltage range.".format(name))
+    high = float(span[:-len('VOLTS')].replace('PT', '.'))
+    return (-high if polarity == 'BIP' else 0.), high
+
+
+def get_auto_buffer_samples(sample_rate: int, channels_num: int, latency: float) -> int:
+    """Computes the length of the circular AI buffer, samples per channel.
+
+    A half of the buffer lasts several latencies of the read loop, so a late loop doesn't lose data,
+    but not less than the minimal time. The time is rounded up to the minimal time times a power of two,
+    so small changes of the latency don't reallocate the buffer. The buffer is limited by the maximal size
+    for many fast channels.
+
+    Args:
+        sample_rate: AI sample rate, Hz.
+        channels_num: Number of acquired channels.
+        latency: Worst measured time (s) between a half-buffer flip and the moment its data was taken.
+    """
+    required_time = 2 * AI_BUFFER_LATENCY_FACTOR * latency
+    buffer_time = AI_BUFFER_MIN_TIME * 2 ** max(int(np.ceil(np.log2(required_time / AI_BUFFER_MIN_TIME))), 0) \
+        if required_time > 0 else AI_BUFFER_MIN_TIME
+    samples = min(int(buffer_time * sample_rate), AI_BUFFER_MAX_SIZE // (8 * channels_num))
+    return max(samples - samples % 2, 2)  # halves of equal length
+
+
 class AiDeviceHandler:
-    """Wraps the analog-input uldaq.AiDevice."""
+    """Wraps the analog-input uldaq.AiDevice.
+
+    The handler is meant to live as long as the DAQ connection, see DaqDeviceHandler.get_ai_device_handler,
+    so device capabilities are checked and the buffer is allocated once, not on every run.
+    """
 
     def __init__(self, ai_device_from_daq: ul.AiDevice,
                  params: AiParams):
@@ -34,9 +82,20 @@ class AiDeviceHandler:
         """
         self._ai_device = ai_device_from_daq
         self._params = params
+        self._buffer = None
+        self._buffer_shape = None
+        self._is_buffer_reused = False
+        self._latency = AI_BUFFER_DEFAULT_LATENCY
         self._check_device()
         self._init_buffer()
 
+    def set_params(self, params: AiParams):
+        """Applies parameters of the next scan, the buffer is reallocated only if its size changed."""
+        self._params = params
+        if not self._has_single_ended:
+            self._params.input_mode = ul.AiInputMode.DIFFERENTIAL
+        self._init_buffer()
+
     def _check_device(self):
         if self._ai_device is None:
             error_str = "Error. DAQ device doesn't support analog input."
@@ -49,21 +108,64 @@ class AiDeviceHandler:
             logging.error(error_str)
             raise RuntimeError(error_str)
 
-        if info.get_num_chans_by_mode(ul.AiInputMode.SINGLE_ENDED) <= 0:
+        self._has_single_ended = info.get_num_chans_by_mode(ul.AiInputMode.SINGLE_ENDED) > 0
+        self._resolution = info.get_resolution()
+        if not self._has_single_ended:
             self._params.input_mode = ul.AiInputMode.DIFFERENTIAL
 
+    def set_latency(self, latency: float):
+        """Reports the worst read loop latency (s) of the last scan, used to size the buffer if it's adaptive."""
+        self._latency = latency
+
+    def get_samples_per_channel(self) -> int:
+        """Provides the buffer length, samples per channel."""
+        return self._buffer_shape[1]
+
+    def get_resolution(self) -> int:
+        """Provides the number of bits of the A/D converter."""
+        return self._resolution
+
+    def get_count_dtype(self) -> np.dtype:
+        """Provides the smallest type keeping raw ADC counts, see AiParams.is_scaled."""
+        return np.dtype(np.uint16 if self._resolution <= 16 else np.uint32)
+
+    def get_scaling(self) -> Tuple[float, float]:
+        """Provides the scale (V per count) and the offset (V), so volts = counts * scale + offset.
+
+        The nominal scaling of the range is used, uldaq doesn't expose calibration coefficients of the board.
+        """
+        low, high = get_range_limits(self._params.range_id)
+        return (high - low) / 2 ** self._resolution, low
+
     def _init_buffer(self):
         channel_count = self._params.high_channel - self._params.low_channel + 1
-        self._buffer = ul.create_float_buffer(channel_count, self._params.sample_rate)
+        if self._params.buffer_time == AUTO_BUFFER_TIME:
+            samples_per_channel = get_auto_buffer_samples(self._params.sample_rate, channel_count, self._latency)
+        else:
+            samples_per_channel = max(int(self._params.buffer_time * self._params.sample_rate / 2), 1) * 2
+        self._is_buffer_reused = self._buffer_shape == (channel_count, samples_per_channel)
+        if self._is_buffer_reused:
+            return
+        self._buffer = ul.create_float_buffer(channel_count, samples_per_channel)
+        self._buffer_shape = (channel_count, samples_per_channel)
+        logging.info("AI buffer of {} channels and {} samples per channel allocated.".format(*self._buffer_shape))
 
     def get(self) -> ul.AiDevice:
         """Provides explicit access to the uldaq.AiDevice."""
         return self._ai_device                                   
 
     def get_buffer(self) -> Array[float]:
-        """Returns an array of double precision floating point sample values."""
+        """Returns an array of double precision floating point sample values, or raw ADC counts without scaling."""
         return self._buffer
 
+    def is_buffer_reused(self) -> bool:
+        """Tells if the buffer of the previous scan was kept when the current parameters were applied."""
+        return self._is_buffer_reused
+
+    def get_buffer_view(self) -> np.ndarray:
+        """Returns a NumPy array sharing memory with the uldaq buffer, no data is copied."""
+        return np.ctypeslib.as_array(self._buffer)
+
     def stop(self):
         self._ai_device.scan_stop()
   
@@ -74,6 +176,6 @@ class AiDeviceHandler:
     def scan(self) -> float:
         analog_range = ul.Range(self._params.range_id)
         return self._ai_device.a_in_scan(self._params.low_channel, self._params.high_channel, 
-                                         self._params.input_mode, analog_range, self._params.sample_rate,
+                                         self._params.input_mode, analog_range, self.get_samples_per_channel(),
                                          self._params.sample_rate, self._params.options, 
                                          self._params.scan_flags, self._buffer)
@@ -0,0 +1,211 @@
+from calibration import Calibration
+from ao_device import AoParams
+from constants import AO_BUFFER_CACHE_BUDGET, AO_BUFFER_STORE_FOLDER_REL_PATH, CALIBRATION_PATH, \
+    CALIBRATION_FINGERPRINT_FILE
+
+from collections import OrderedDict
+from ctypes import Array, c_double, sizeof
+from typing import Optional
+import numpy as np
+import threading
+import hashlib
+import logging
+import json
+import glob
+import os
+
+
+def get_profile_provenance(time_temp_table: dict, calibration: Calibration, ao_params: AoParams) -> dict:
+    """Returns everything an armed AO buffer depends on.
+
+    Args:
+        time_temp_table: Temperature profile like {'time': [...], 'temperature': [...]}.
+        calibration: Calibration, all its public coefficients are taken into account.
+        ao_params: AoParams, only channels, sample rate and temperature conversion change the buffer.
+    """
+    calibration_params = {name: value for name, value in vars(calibration).items() if not name.startswith('_')}
+    return dict(time=[float(t) for t in time_temp_table['time']],
+                temperature=[float(t) for t in time_temp_table['temperature']],
+                calibration=calibration_params,
+                ao=dict(sample_rate=ao_params.sample_rate,
+                        low_channel=ao_params.low_channel,
+                        high_channel=ao_params.high_channel,
+                        temperature_conversion=ao_params.temperature_conversion))
+
+
+def get_profile_key(time_temp_table: dict, calibration: Calibration, ao_params: AoParams) -> str:
+    """Returns a hash of the profile provenance, see get_profile_provenance."""
+    provenance = get_profile_provenance(time_temp_table, calibration, ao_params)
+    return hashlib.sha256(json.dumps(provenance, sort_keys=True).encode()).hexdigest()
+
+
+class AoBufferStore:
+    """Keeps armed AO buffers on disk as .npy files named by their provenance hash, so they survive restarts.
+
+    Buffers are memory-mapped copy-on-write when loaded, so arming costs neither reading nor copying
+    of the whole waveform. All files are removed when the calibration file changes.
+    """
+
+    def __init__(self, folder: str = AO_BUFFER_STORE_FOLDER_REL_PATH, calibration_path: str = CALIBRATION_PATH):
+        """Creates the folder if needed.
+
+        Args:
+            folder: A string path to the folder with stored buffers.
+            calibration_path: A string path to the calibration file, whose changes invalidate stored buffers.
+        """
+        self._folder = folder
+        self._calibration_path = calibration_path
+        self._calibration_fingerprint = None
+        if not os.path.exists(self._folder):
+            os.makedirs(self._folder)
+
+    def load(self, key: str) -> Optional[Array[float]]:
+        """Maps the stored buffer with the key, returns None if there is no such buffer."""
+        self._check_calibration()
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = np.load(path, mmap_mode='c')
+            # the ctypes array keeps a reference to the map, pages are read by the OS on access
+            return (c_double * data.size).from_buffer(data)
+        except (OSError, ValueError) as e:
+            logging.error("ERROR. Stored AO buffer {} cannot be loaded: {}".format(path, e))
+            return None
+
+    def save(self, key: str, buffer: Array[float], provenance: Optional[dict] = None):
+        """Writes the buffer and, if given, its provenance next to it."""
+        self._check_calibration()
+        path = self._get_path(key)
+        try:
+            # written under a temporary name, so a file with the key is always complete
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ctypeslib.as_array(buffer))
+            os.replace(path + '.tmp', path)
+            if provenance is not None:
+                with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+                    json.dump(dict(key=key, provenance=provenance), f, indent=4)
+        except OSError as e:
+            logging.error("ERROR. AO buffer cannot be stored to {}: {}".format(path, e))
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self._folder, '*.npy')) + glob.glob(os.path.join(self._folder, '*.json')):
+            os.remove(path)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._folder, key + '.npy')
+
+    def _check_calibration(self):
+        # the fingerprint of the calibration file is compared with the one the buffers were stored with
+        if os.path.exists(self._calibration_path):
+            with open(self._calibration_path, 'rb') as f:
+                fingerprint = hashlib.sha256(f.read()).hexdigest()
+        else:
+            fingerprint = ''
+        if fingerprint == self._calibration_fingerprint:
+            return
+
+        fingerprint_path = os.path.join(self._folder, CALIBRATION_FINGERPRINT_FILE)
+        stored_fingerprint = None
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as f:
+                stored_fingerprint = f.read().strip()
+        if stored_fingerprint != fingerprint:
+            logging.info("Calibration file changed, stored AO buffers are removed.")
+            self.clear()
+            with open(fingerprint_path, 'w') as f:
+                f.write(fingerprint)
+        self._calibration_fingerprint = fingerprint
+
+
+class AoBufferCache:
+    """Keeps interleaved AO buffers of armed profiles, so identical protocols are armed without recomputing.
+
+    Buffers are kept while their total size fits into the memory budget, the least recently used ones
+    are dropped first. With a store, missing buffers are looked for on disk and new ones are written there too.
+    Buffers are shared, so they must not be changed after they are put.
+    """
+
+    def __init__(self, memory_budget: int = AO_BUFFER_CACHE_BUDGET, store: Optional[AoBufferStore] = None):
+        """Initializes an empty cache.
+
+        Args:
+            memory_budget: Maximal total size (bytes) of kept buffers.
+            store: AoBufferStore, keeping buffers across restarts.
+        """
+        self._memory_budget = memory_budget
+        self._store = store
+        self._store_hits = 0
+        self._buffers = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: str) -> Optional[Array[float]]:
+        """Returns the buffer with the key, None if there is no such buffer."""
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is not None:
+                self._buffers.move_to_end(key)
+                self._hits += 1
+                return buffer
+
+        buffer = self._store.load(key) if self._store is not None else None
+        with self._lock:
+            if buffer is None:
+                self._misses += 1
+                return None
+            self._store_hits += 1
+        self._put_to_memory(key, buffer)
+        return buffer
+
+    def put(self, key: str, buffer: Array[float], provenance: Optional[dict] = None):
+        """Adds the buffer, dropping the least recently used ones beyond the memory budget.
+
+        Args:
+            key: Provenance hash of the buffer.
+            buffer: Interleaved AO buffer.
+            provenance: Provenance of the buffer, stored next to it on disk.
+        """
+        if self._store is not None:
+            self._store.save(key, buffer, provenance)
+        self._put_to_memory(key, buffer)
+
+    def _put_to_memory(self, key: str, buffer: Array[float]):
+        size = sizeof(buffer)
+        if size > self._memory_budget:
+            logging.warning("WARNING. AO buffer of {} bytes exceeds the cache budget of {} bytes and is not "
+                            "cached.".format(size, self._memory_budget))
+            return
+        with self._lock:
+            if key in self._buffers:
+                self._size -= sizeof(self._buffers.pop(key))
+            while self._buffers and self._size + size > self._memory_budget:
+                _, evicted = self._buffers.popitem(last=False)
+                self._size -= sizeof(evicted)
+                self._evictions += 1
+            self._buffers[key] = buffer
+            self._size += size
+
+    def clear(self):
+        """Removes all buffers, also the stored ones."""
+        with self._lock:
+            self._buffers.clear()
+            self._size = 0
+        if self._store is not None:
+            self._store.clear()
+
+    def get_metrics(self) -> dict:
+        """Provides the number and the size (bytes) of kept buffers and hits, misses and evictions so far."""
+        with self._lock:
+            requests = self._hits + self._store_hits + self._misses
+            return dict(entries=len(self._buffers),
+                        size=self._size,
+                        memory_budget=self._memory_budget,
+                        hits=self._hits,
+                        store_hits=self._store_hits,
+                        misses=self._misses,
+                        evictions=self._evictions,
+                        hit_rate=(self._hits + self._store_hits) / requests if requests else 0.)
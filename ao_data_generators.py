@@ -1,7 +1,13 @@
+from typing import Callable, Union
 from ctypes import Array
+from fractions import Fraction
+import logging
 
+import numpy as np
 import uldaq as ul
 
+from constants import MODULATION_TABLE_MAX_SAMPLES
+
 # TODO: add an interface class for different types of data generators
 
 
@@ -25,17 +31,10 @@ class PulseDataGenerator:
         self._buffer = ul.create_float_buffer(self._channel_count, self._buffer_size)
 
     def _fill_buffer(self):
-        ch_list = list(range(self._low_channel, self._high_channel + 1))
-        ch_list = ['ch' + str(i) for i in ch_list]
-
-        for i in ch_list:
-            if i not in list(self._channel_voltages.keys()):
-                self._channel_voltages[i] = 0.
-        
-        print(self._channel_voltages['ch' + str(1)])
-        for i in range(self._buffer_size):
-            for ch in range(self._low_channel, self._high_channel + 1):
-                self._buffer[i * self._channel_count + ch] = self._channel_voltages['ch' + str(ch)]
+        # (samples, channels) view of the interleaved buffer, unused channels stay 0
+        buffer = np.ctypeslib.as_array(self._buffer).reshape(self._buffer_size, self._channel_count)
+        for ch in range(self._low_channel, self._high_channel + 1):
+            buffer[:, ch - self._low_channel] = self._channel_voltages.get('ch' + str(ch), 0.)
 
     def get_buffer(self) -> Array[float]:
         return self._buffer
@@ -48,6 +47,7 @@ class ScanDataGenerator:
     # The buffer for AO device of daqboard should be linear.
     # This class generates the linear buffer from dictionary, some kind of 2D array
     # like {'ch0': [.......], 'ch3': [........]}. Unused channels are being set to 0.
+    # Profiles can be lists or numpy arrays, they are written column-wise into a numpy view of the buffer.
 
     def __init__(self, voltage_profiles: dict,
                  low_channel: int, high_channel: int):
@@ -73,16 +73,12 @@ class ScanDataGenerator:
         if len(set(lens_with_bf)) > 1:
             raise ValueError("Cannot load analog output buffer. "
                              "One of the channel profile has length, different from buffer size.")
-        ch_list = list(range(self._low_channel, self._high_channel + 1))
-        ch_list = ['ch' + str(i) for i in ch_list]
-        
-        for i in ch_list:
-            if i not in self._voltage_profiles.keys():
-                self._voltage_profiles[i] = [0.] * self._buffer_size
-
-        for i in range(self._buffer_size):
-            for ch in range(self._low_channel, self._high_channel + 1):
-                self._buffer[i * self._channel_count + ch] = self._voltage_profiles['ch' + str(ch)][i]
+        # (samples, channels) view of the interleaved buffer, unused channels stay 0
+        buffer = np.ctypeslib.as_array(self._buffer).reshape(self._buffer_size, self._channel_count)
+        for ch in range(self._low_channel, self._high_channel + 1):
+            profile = self._voltage_profiles.get('ch' + str(ch))
+            if profile is not None:
+                buffer[:, ch - self._low_channel] = profile
 
     def get_buffer(self) -> Array[float]:
         return self._buffer
@@ -91,23 +87,156 @@ class ScanDataGenerator:
         return str(vars(self))
 
 
+# a channel profile is either the whole array of voltages or a function of sample indices
+ChannelProfile = Union[np.ndarray, list, Callable[[np.ndarray], np.ndarray]]
+
+
+def get_profile_length(voltage_profiles: dict) -> int:
+    """Returns the number of samples per channel of the profiles with arrays of voltages.
+
+    Raises:
+        ValueError if no profile is an array or array profiles have different length.
+    """
+    lens = set(len(profile) for profile in voltage_profiles.values() if not callable(profile))
+    if len(lens) != 1:
+        raise ValueError("Cannot get analog output profile length, it should be defined by arrays of equal length.")
+    return lens.pop()
+
+
+class StreamDataGenerator:
+    # This class generates the linear AO buffer chunk by chunk, for profiles played through a circular buffer.
+    # Profiles are given by a dictionary like {'ch0': [.......], 'ch3': function}, where a function gets
+    # an array of sample indices and returns voltages, so long profiles don't have to be kept in memory.
+    # Unused channels are being set to 0.
+
+    def __init__(self, voltage_profiles: dict, low_channel: int, high_channel: int, samples_num: int):
+        self._voltage_profiles = voltage_profiles
+        self._low_channel = low_channel
+        self._high_channel = high_channel
+        self._channel_count = self._high_channel - self._low_channel + 1
+        self._samples_num = samples_num
+        self._last_values = np.zeros(self._channel_count)
+
+    def get_samples_num(self) -> int:
+        return self._samples_num
+
+    def fill(self, buffer: np.ndarray, start: int) -> int:
+        """Fills the (samples, channels) buffer with the profile samples beginning with start.
+
+        After the end of the profile the rest of the buffer keeps the last values of the profile.
+
+        Returns:
+            Number of profile samples written.
+        """
+        count = max(min(len(buffer), self._samples_num - start), 0)
+        if count:
+            indices = np.arange(start, start + count)
+            for ch in range(self._low_channel, self._high_channel + 1):
+                profile = self._voltage_profiles.get('ch' + str(ch))
+                column = buffer[:count, ch - self._low_channel]
+                if profile is None:
+                    column[:] = 0.
+                else:
+                    column[:] = profile(indices) if callable(profile) else profile[start:start + count]
+            self._last_values[:] = buffer[count - 1]
+        buffer[count:] = self._last_values
+        return count
+
+    def __str__(self):
+        return str(vars(self))
+
+
+class ModulationGenerator:
+    # This class generates the AC modulation offset + amplitude * sin(2 * pi * frequency * t + phase)
+    # for the reference channel. One table, holding a whole number of periods, is precomputed, and samples
+    # are taken from it by their index in the profile, so the waveform stays phase-continuous across
+    # streamed chunks and sin is never evaluated per sample.
+
+    def __init__(self, amplitude: float, offset: float, frequency: float, sample_rate: int,
+                 phase: float = 0., max_table_samples: int = MODULATION_TABLE_MAX_SAMPLES):
+        if frequency < 0 or sample_rate <= 0:
+            raise ValueError("Cannot generate modulation of {} Hz at {} Hz sample rate.".format(frequency, sample_rate))
+        self._amplitude = amplitude
+        self._offset = offset
+        self._sample_rate = sample_rate
+        self._phase = phase
+
+        # frequency / sample_rate = periods / samples of the shortest table, both integers
+        ratio = Fraction(frequency / sample_rate).limit_denominator(max_table_samples)
+        self._periods_num, self._table_len = ratio.numerator, ratio.denominator
+        self._frequency = self._periods_num * sample_rate / self._table_len
+        if self._frequency != frequency:
+            logging.warning("WARNING. Modulation frequency is set to {} Hz instead of {} Hz to fit into a table "
+                            "of {} samples.".format(self._frequency, frequency, max_table_samples))
+
+        self._table = offset + amplitude * np.sin(self.get_phase(np.arange(self._table_len)))
+        self._table.flags.writeable = False
+
+    def __call__(self, indices: np.ndarray) -> np.ndarray:
+        """Returns modulation voltages of the given profile samples."""
+        return self._table[indices % self._table_len]
+
+    def get_profile(self, samples_num: int, start: int = 0) -> np.ndarray:
+        """Returns modulation voltages of samples_num profile samples beginning with start."""
+        return np.resize(np.roll(self._table, -(start % self._table_len)), samples_num)
+
+    def get_phase(self, indices: np.ndarray) -> np.ndarray:
+        """Returns the reference phase (rad) of the given profile samples, computed exactly for any index."""
+        return 2 * np.pi * ((self._periods_num * indices) % self._table_len) / self._table_len + self._phase
+
+    def get_reference(self) -> dict:
+        """Provides the modulation parameters, needed for demodulation of the acquired signal.
+
+        The phase is the one of the first AO sample, frequency is the actually generated one.
+        """
+        return dict(modulation_amplitude=self._amplitude,
+                    modulation_offset=self._offset,
+                    modulation_frequency=self._frequency,
+                    modulation_phase=self._phase,
+                    modulation_sample_rate=self._sample_rate)
+
+    def __str__(self):
+        return str(vars(self))
+
+
 if __name__ == '__main__':
-    try:
-        from numpy import linspace
-
-        local_voltage_profiles = {
-            'ch0': 2,
-            'ch2': 1
-        }
-        ao_data_generator = PulseDataGenerator(local_voltage_profiles, 100, 0, 3)
-        buffer = ao_data_generator.get_buffer()
-
-        import matplotlib.pyplot as plt
-        plt.plot(buffer[::4])
-        plt.plot(buffer[1::4])
-        plt.plot(buffer[2::4])
-        plt.plot(buffer[3::4])
-        plt.show()
-
-    except BaseException as e:
-        print(e)
+    # Benchmark of the AO buffer filling against the former per-element loop.
+    # usage: python ao_data_generators.py [duration_s] [sample_rate]
+    import sys
+    from time import perf_counter
+
+    def _fill_buffer_loop(voltage_profiles: dict, low_channel: int, high_channel: int) -> Array[float]:
+        channel_count = high_channel - low_channel + 1
+        buffer_size = len(list(voltage_profiles.values())[0])
+        loop_buffer = ul.create_float_buffer(channel_count, buffer_size)
+        profiles = {'ch' + str(ch): voltage_profiles.get('ch' + str(ch), [0.] * buffer_size)
+                    for ch in range(low_channel, high_channel + 1)}
+        for i in range(buffer_size):
+            for ch in range(low_channel, high_channel + 1):
+                loop_buffer[i * channel_count + ch - low_channel] = profiles['ch' + str(ch)][i]
+        return loop_buffer
+
+    _duration = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    _sample_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    _samples = _duration * _sample_rate
+    _profiles = {'ch0': np.full(_samples, 0.1), 'ch1': np.linspace(0., 5., _samples)}
+
+    _t1 = perf_counter()
+    _buffer = ScanDataGenerator(_profiles, 0, 3).get_buffer()
+    _t2 = perf_counter()
+    _loop_buffer = _fill_buffer_loop(_profiles, 0, 3)
+    _t3 = perf_counter()
+
+    assert np.array_equal(np.ctypeslib.as_array(_buffer), np.ctypeslib.as_array(_loop_buffer))
+    print("{} s at {} Hz x 4 channels: vectorized {:.3f} s, loop {:.3f} s, x{:.0f}".format(
+        _duration, _sample_rate, _t2 - _t1, _t3 - _t2, (_t3 - _t2) / (_t2 - _t1)))
+
+    # modulation from the precomputed table against sin per sample
+    _modulation = ModulationGenerator(0.05, 0.1, 75., _sample_rate)
+    _t1 = perf_counter()
+    _table_profile = _modulation.get_profile(_samples)
+    _t2 = perf_counter()
+    _sin_profile = 0.1 + 0.05 * np.sin(2 * np.pi * 75. * np.arange(_samples) / _sample_rate)
+    _t3 = perf_counter()
+    print("modulation of {} samples: table {:.3f} s, sin {:.3f} s, max difference {:.1e} V".format(
+        _samples, _t2 - _t1, _t3 - _t2, np.abs(_table_profile - _sin_profile).max()))
@@ -1,5 +1,7 @@
 from typing import Tuple
 
+from constants import LOOKUP_CONVERSION
+
 import uldaq as ul
 import logging
 
@@ -12,13 +14,18 @@ class AoParams:
         self.high_channel = -1
         self.scan_flags = ul.AOutScanFlag.DEFAULT  # 0
         self.options = ul.ScanOption.CONTINUOUS  # 8
+        self.stream_buffer = 0.  # s, length of the circular buffer for streamed profiles, 0 - no streaming
+        self.temperature_conversion = LOOKUP_CONVERSION  # how heater temperatures are turned into voltages
 
     def __str__(self):
         return str(vars(self))
 
 
 class AoDeviceHandler:
-    """Wraps the analog-output uldaq.AoDevice."""
+    """Wraps the analog-output uldaq.AoDevice.
+
+    The handler is meant to live as long as the DAQ connection, see DaqDeviceHandler.get_ao_device_handler.
+    """
 
     def __init__(self, ao_device_from_daq: ul.AoDevice,
                  params: AoParams):
@@ -35,6 +42,10 @@ class AoDeviceHandler:
         self._check_device()
         self._params = params
 
+    def set_params(self, params: AoParams):
+        """Applies parameters of the next scan."""
+        self._params = params
+
     def _check_device(self):
         if self._ao_device is None:
             error_str = "Error. DAQ device doesn't support analog output."
@@ -57,6 +68,14 @@ class AoDeviceHandler:
     def status(self) -> Tuple[ul.ScanStatus, ul.TransferStatus]:
         return self._ao_device.get_scan_status()
 
+    def set_voltage(self, channel: int, voltage: float):
+        """Stops the scan, if any, and sets a constant voltage on the channel."""
+        # the board refuses single outputs while a scan is running
+        status, _ = self.status()
+        if status == ul.ScanStatus.RUNNING:
+            self.stop()
+        self._ao_device.a_out(channel, ul.Range(self._params.range_id), ul.AOutFlag.DEFAULT, voltage)
+
     # returns actual output scan rate
     def scan(self, ao_buffer) -> float:
         analog_range = ul.Range(self._params.range_id)
@@ -0,0 +1,98 @@
+from typing import Optional
+import threading
+import logging
+
+import numpy as np
+import uldaq as ul
+
+from ao_device import AoDeviceHandler
+from ao_data_generators import StreamDataGenerator
+
+
+class AoStreamer:
+    """Plays an AO profile of any length through a fixed-size circular buffer.
+
+    The buffer consists of two halves. While the board plays one of them, a background thread refills
+    the other one with the next chunk from the generator, so memory use doesn't depend on profile length.
+    If the board gets to samples which weren't refilled in time, the underrun is counted in metrics.
+    """
+
+    def __init__(self, ao_device_handler: AoDeviceHandler, generator: StreamDataGenerator,
+                 samples_per_half: int, channels_num: int, sample_rate: int):
+        self._ao_device_handler = ao_device_handler
+        self._generator = generator
+        self._samples_per_half = samples_per_half
+        self._sample_rate = sample_rate
+
+        self._buffer = ul.create_float_buffer(channels_num, 2 * samples_per_half)
+        self._halves = np.ctypeslib.as_array(self._buffer).reshape(2, samples_per_half, channels_num)
+        self._samples_written = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._refills = 0
+        self._underruns = 0
+        self._underrun_samples = 0
+        self._min_margin = float(2 * samples_per_half)
+
+    def start(self) -> float:
+        """Fills both halves, starts the continuous AO scan and the refilling thread.
+
+        Returns:
+            Actual output scan rate.
+        """
+        for half in self._halves:
+            self._generator.fill(half, self._samples_written)
+            self._samples_written += self._samples_per_half
+
+        rate = self._ao_device_handler.scan(self._buffer)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refill_loop, name="AoStreamer", daemon=True)
+        self._thread.start()
+        return rate
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._ao_device_handler.stop()
+
+    def get_metrics(self) -> dict:
+        return dict(refills=self._refills,
+                    underruns=self._underruns,
+                    underrun_samples=self._underrun_samples,
+                    min_margin=self._min_margin / self._sample_rate)
+
+    def _refill_loop(self):
+        # checking the position four times per half, so a half is refilled long before it is played again
+        poll_time = self._samples_per_half / self._sample_rate / 4
+        samples_num = self._generator.get_samples_num()
+        try:
+            while not self._stop_event.is_set():
+                status, transfer_status = self._ao_device_handler.status()
+                played = transfer_status.current_scan_count
+                if played >= samples_num:
+                    break
+                if status != ul.ScanStatus.RUNNING:
+                    logging.error("AO STREAM: ERROR. AO scan stopped after {} of {} samples.".format(played,
+                                                                                                  samples_num))
+                    break
+
+                # the half before the one being played is free to be refilled
+                while played >= self._samples_written - self._samples_per_half:
+                    if played >= self._samples_written:
+                        self._underruns += 1
+                        self._underrun_samples += played - self._samples_written + 1
+                        logging.warning("AO STREAM: WARNING. Underrun, {} samples were played from stale "
+                                        "buffer.".format(played - self._samples_written + 1))
+                    self._min_margin = min(self._min_margin, self._samples_written - played)
+                    half = self._halves[(self._samples_written // self._samples_per_half) % 2]
+                    self._generator.fill(half, self._samples_written)
+                    self._samples_written += self._samples_per_half
+                    self._refills += 1
+                self._stop_event.wait(poll_time)
+        except BaseException as e:
+            logging.error("AO STREAM: ERROR. Refilling of AO buffer failed: {}".format(e))
+        finally:
+            self._ao_device_handler.stop()
@@ -0,0 +1,335 @@
+"""Benchmarks of the hot paths, run without hardware on the simulated DAQ backend.
+
+Every benchmark is run for each combination of AI/AO sample rate, channel count and profile duration,
+results are saved as JSON, so they can be compared between versions.
+
+usage: python benchmark.py [--rates 20000 1000000] [--channels 2 6] [--durations 1 5] [--repeats 5]
+                           [--only scan_generator ...] [--output results.json] [--compare baseline.json]
+"""
+from ao_data_generators import ScanDataGenerator, PulseDataGenerator
+from calibration import Calibration
+from daq_device import DaqDeviceHandler, DaqParams
+from experiment_manager import ExperimentManager
+from fastheat import FastHeat
+from raw_data_store import RawDataStore, StorageParams
+from settings import SettingsParser
+from sim_device import SIM_SHUNT_RATIO, SIM_TPL_GAIN, SIM_AUX_VOLTAGE
+from utils import deinterleave, temperature_to_voltage
+from constants import CALIBRATION_PATH, SETTINGS_PATH, RAW_DATA_FILE_REL_PATH, RAW_DATA_FOLDER_REL_PATH, \
+    RAW_DATA_DATASET, SIMULATED_BACKEND, BENCHMARK_FOLDER_REL_PATH, BENCHMARK_FILE_FORMAT, \
+    BENCHMARK_SAMPLE_RATES, BENCHMARK_CHANNELS, BENCHMARK_DURATIONS, BENCHMARK_REPEATS, NO_COMPRESSION, \
+    NO_SHUFFLE, BYTE_SHUFFLE, BIT_SHUFFLE
+
+from typing import Callable, Dict, List, Optional
+from functools import partial
+import numpy as np
+import pandas as pd
+import subprocess
+import platform
+import argparse
+import tempfile
+import logging
+import shutil
+import time
+import json
+import os
+
+CALORIMETER_CHANNELS = 6  # AI channels the calibration needs, see calibration_engine
+BLOCK_TIME = 0.5  # s, a block of the HDF5 write benchmark is a half of the default 1 s AI buffer
+ADC_STEP = 20. / 2 ** 16  # V, 16 bit AI codes in the BIP10VOLTS range
+ADC_NOISE = 2.  # noise of realistic signals, ADC steps
+
+# compressions of the write benchmark: (compression, level, shuffle)
+BENCHMARK_COMPRESSIONS = [(NO_COMPRESSION, 0, NO_SHUFFLE),
+                          ('zlib', 1, BYTE_SHUFFLE),
+                          ('blosc:lz4', 5, BYTE_SHUFFLE),
+                          ('blosc:lz4', 5, BIT_SHUFFLE),
+                          ('blosc:zstd', 5, BIT_SHUFFLE)]
+
+
+class BenchmarkCase:
+    """Parameters of one benchmark run and data shared by the benchmarks of the case."""
+
+    def __init__(self, sample_rate: int, channels_num: int, duration: int,
+                 calibration: Calibration, settings_parser: SettingsParser, daq_device_handler: DaqDeviceHandler):
+        self.sample_rate = sample_rate
+        self.channels_num = channels_num
+        self.duration = duration
+        self.samples_num = sample_rate * duration
+        self.calibration = calibration
+        self.settings_parser = settings_parser
+        self.daq_device_handler = daq_device_handler
+
+    def get_raw(self, channels_num: int) -> np.ndarray:
+        """Synthetic (samples, channels) AI voltages, the calorimeter channels are within calibrated ranges."""
+        rng = np.random.default_rng(0)
+        raw = rng.normal(0.01, 0.001, (self.samples_num, channels_num))
+        raw[:, :min(channels_num, CALORIMETER_CHANNELS)] += [0.001, 0.02, 0., 0.25, 0.01, 1.][:channels_num]
+        return raw
+
+    def get_signals(self, channels_num: int) -> np.ndarray:
+        """Realistic (samples, channels) AI voltages of a heating ramp, quantized like the board does.
+
+        Channels follow the calorimeter model of the simulated device: heater current, modulation,
+        unused, AD595, thermopile and heater voltage, further channels are unused. Noise is a few ADC steps.
+        """
+        rng = np.random.default_rng(0)
+        times = np.arange(self.samples_num) / self.sample_rate
+        heater = 4. * (1. - np.abs(2. * times / self.duration - 1.))
+        modulation = 0.1 + 0.05 * np.sin(2 * np.pi * 75. * times)
+        signals = np.zeros((self.samples_num, channels_num))
+        model = [heater * SIM_SHUNT_RATIO, modulation * 0.121, 0., SIM_AUX_VOLTAGE, heater * heater * SIM_TPL_GAIN,
+                 heater]
+        for channel in range(min(channels_num, len(model))):
+            signals[:, channel] = model[channel]
+        signals += rng.normal(0., ADC_NOISE * ADC_STEP, signals.shape)
+        return np.round(signals / ADC_STEP) * ADC_STEP
+
+    def get_time_temp_table(self) -> dict:
+        duration_ms = 1000. * self.duration
+        return dict(time=[0., 0.1 * duration_ms, 0.5 * duration_ms, 0.9 * duration_ms, duration_ms],
+                    temperature=[0., 0., 300., 0., 0.])
+
+
+# each benchmark prepares its data and returns the function to be timed
+def bench_scan_generator(case: BenchmarkCase) -> Callable[[], None]:
+    profiles = {'ch0': np.full(case.samples_num, 0.1), 'ch1': np.linspace(0., 5., case.samples_num)}
+    return lambda: ScanDataGenerator(profiles, 0, case.channels_num - 1).get_buffer()
+
+
+def bench_pulse_generator(case: BenchmarkCase) -> Callable[[], None]:
+    voltages = {'ch0': 0.1, 'ch1': 1.}
+    return lambda: PulseDataGenerator(voltages, case.samples_num, 0, case.channels_num - 1).get_buffer()
+
+
+def bench_temperature_to_voltage(case: BenchmarkCase) -> Callable[[], None]:
+    temp = np.concatenate((np.linspace(0., 300., case.samples_num // 2),
+                           np.linspace(300., 0., case.samples_num - case.samples_num // 2)))
+    return lambda: temperature_to_voltage(temp, case.calibration)
+
+
+def bench_channel1_voltage(case: BenchmarkCase) -> Callable[[], None]:
+    fh = _create_fast_heat(case)
+    return lambda: fh._get_channel1_voltage()
+
+
+def bench_apply_calibration(case: BenchmarkCase) -> Callable[[], None]:
+    fh = _create_fast_heat(case)
+    raw = case.get_raw(CALORIMETER_CHANNELS)
+    return lambda: fh._apply_calibration(raw)
+
+
+def bench_raw_data_write(case: BenchmarkCase) -> Callable[[], None]:
+    # the path of a run: interleaved half-buffers are deinterleaved and written into one chunked dataset
+    block_samples = max(int(BLOCK_TIME * case.sample_rate), 1)
+    blocks_num = -(-case.samples_num // block_samples)
+    interleaved = case.get_raw(case.channels_num).ravel()
+    block_len = block_samples * case.channels_num
+
+    def write():
+        store = RawDataStore(RAW_DATA_FILE_REL_PATH, case.samples_num, case.channels_num, block_samples)
+        for block_index in range(blocks_num):
+            block = interleaved[block_index * block_len:(block_index + 1) * block_len]
+            store.write_rows(RAW_DATA_DATASET, deinterleave(block, case.channels_num), block_index)
+        store.close()
+    return write
+
+
+def bench_raw_counts_write(case: BenchmarkCase) -> Callable[[], dict]:
+    # the same path as raw_data_write for the NOSCALEDATA scan flag, 16 bit ADC counts are stored
+    block_samples = max(int(BLOCK_TIME * case.sample_rate), 1)
+    blocks_num = -(-case.samples_num // block_samples)
+    interleaved = np.round(case.get_signals(case.channels_num).ravel() / ADC_STEP + 2 ** 15).astype(np.uint16)
+    block_len = block_samples * case.channels_num
+
+    def write() -> dict:
+        store = RawDataStore(RAW_DATA_FILE_REL_PATH, case.samples_num, case.channels_num, block_samples,
+                             raw_dtype=np.uint16)
+        store.set_scaling(ADC_STEP, -10.)
+        for block_index in range(blocks_num):
+            block = interleaved[block_index * block_len:(block_index + 1) * block_len]
+            store.write_rows(RAW_DATA_DATASET, deinterleave(block, case.channels_num), block_index)
+        bytes_written = store.get_bytes_written()
+        store.close()
+        return dict(bytes_written=bytes_written, file_size=os.path.getsize(RAW_DATA_FILE_REL_PATH))
+    return write
+
+
+def bench_compressed_write(case: BenchmarkCase, compression: str, compression_level: int,
+                           shuffle: str) -> Callable[[], dict]:
+    # the same path as raw_data_write on realistic signals, the compression ratio is reported too
+    storage_params = StorageParams()
+    storage_params.compression, storage_params.compression_level, storage_params.shuffle = \
+        compression, compression_level, shuffle
+    block_samples = max(int(BLOCK_TIME * case.sample_rate), 1)
+    blocks_num = -(-case.samples_num // block_samples)
+    interleaved = case.get_signals(case.channels_num).ravel()
+    block_len = block_samples * case.channels_num
+
+    def write() -> dict:
+        store = RawDataStore(RAW_DATA_FILE_REL_PATH, case.samples_num, case.channels_num, block_samples,
+                             filters=storage_params.get_filters())
+        for block_index in range(blocks_num):
+            block = interleaved[block_index * block_len:(block_index + 1) * block_len]
+            store.write_rows(RAW_DATA_DATASET, deinterleave(block, case.channels_num), block_index)
+        bytes_on_disk = store.get_bytes_on_disk()
+        store.close()
+        return dict(compression=compression, compression_level=compression_level, shuffle=shuffle,
+                    bytes_on_disk=bytes_on_disk, compression_ratio=interleaved.nbytes / bytes_on_disk,
+                    file_size=os.path.getsize(RAW_DATA_FILE_REL_PATH))
+    return write
+
+
+def bench_get_ai_data(case: BenchmarkCase) -> Callable[[], None]:
+    store = RawDataStore(RAW_DATA_FILE_REL_PATH, case.samples_num, case.channels_num, case.samples_num)
+    store.write_rows(RAW_DATA_DATASET, case.get_raw(case.channels_num), 0)
+    store.close()
+    em = ExperimentManager(case.daq_device_handler, dict(), case.settings_parser)
+    channels = list(range(case.channels_num))
+    return lambda: em.get_ai_data(channels)
+
+
+def _create_fast_heat(case: BenchmarkCase) -> FastHeat:
+    return FastHeat(case.daq_device_handler, case.settings_parser, case.get_time_temp_table(), case.calibration)
+
+
+# name: (benchmark, its fixed channel count or None if it's run for all channel counts)
+BENCHMARKS: Dict[str, tuple] = dict(scan_generator=(bench_scan_generator, None),
+                                    pulse_generator=(bench_pulse_generator, None),
+                                    temperature_to_voltage=(bench_temperature_to_voltage, 1),
+                                    channel1_voltage=(bench_channel1_voltage, 1),
+                                    apply_calibration=(bench_apply_calibration, CALORIMETER_CHANNELS),
+                                    raw_data_write=(bench_raw_data_write, None),
+                                    raw_counts_write=(bench_raw_counts_write, None),
+                                    get_ai_data=(bench_get_ai_data, None))
+for _compression, _level, _shuffle in BENCHMARK_COMPRESSIONS:
+    BENCHMARKS['write_{}_{}_{}'.format(_compression.replace(':', '_'), _level, _shuffle)] = \
+        (partial(bench_compressed_write, compression=_compression, compression_level=_level, shuffle=_shuffle), None)
+
+
+def time_function(function: Callable[[], Optional[dict]], repeats: int) -> dict:
+    """Times the function after a warm-up call, the minimum is the most reproducible estimate.
+
+    If the function returns a dictionary, e.g. with a compression ratio, it's added to the results.
+    """
+    function()
+    times = []
+    extra_results = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        extra_results = function()
+        times.append(time.perf_counter() - start)
+    results = dict(min=min(times), median=float(np.median(times)), mean=float(np.mean(times)), repeats=repeats)
+    if isinstance(extra_results, dict):
+        results.update(extra_results)
+    return results
+
+
+def run_benchmarks(sample_rates: List[int], channels_nums: List[int], durations: List[int], repeats: int,
+                   names: Optional[List[str]] = None) -> List[dict]:
+    """Runs the benchmarks for all combinations of parameters.
+
+    Args:
+        sample_rates: AI and AO sample rates, Hz.
+        channels_nums: Numbers of AI or AO channels, for benchmarks, which depend on them.
+        durations: Profile durations, whole seconds.
+        repeats: Number of timed calls of every benchmark.
+        names: Names of benchmarks to run, all by default.
+
+    Returns:
+        Results like {'name': ..., 'sample_rate': ..., 'channels_num': ..., 'duration': ..., 'min': ...}.
+    """
+    calibration = Calibration()
+    if os.path.exists(CALIBRATION_PATH):
+        calibration.read(CALIBRATION_PATH)
+    settings_parser = SettingsParser(SETTINGS_PATH)
+    daq_params = DaqParams()
+    daq_params.backend = SIMULATED_BACKEND
+    daq_device_handler = DaqDeviceHandler(daq_params)
+
+    results = []
+    # raw data files are written into a temporary folder, so acquired data is not overwritten
+    working_folder = os.getcwd()
+    temp_folder = tempfile.mkdtemp()
+    os.chdir(temp_folder)
+    try:
+        os.makedirs(RAW_DATA_FOLDER_REL_PATH)
+        for sample_rate in sample_rates:
+            settings_parser.get_ai_params().sample_rate = sample_rate
+            settings_parser.get_ao_params().sample_rate = sample_rate
+            for duration in durations:
+                for name, (benchmark, fixed_channels_num) in BENCHMARKS.items():
+                    if names is not None and name not in names:
+                        continue
+                    for channels_num in channels_nums if fixed_channels_num is None else [fixed_channels_num]:
+                        case = BenchmarkCase(sample_rate, channels_num, duration, calibration, settings_parser,
+                                             daq_device_handler)
+                        result = dict(name=name, sample_rate=sample_rate, channels_num=channels_num,
+                                      duration=duration, samples_num=case.samples_num)
+                        result.update(time_function(benchmark(case), repeats))
+                        result['samples_per_s'] = case.samples_num / result['min'] if result['min'] > 0 else 0.
+                        print("{name:>28} {sample_rate:>8} Hz {channels_num:>2} ch {duration:>3} s: "
+                              "min {min:.4f} s, median {median:.4f} s, {samples_per_s:.3g} samples/s".format(**result) +
+                              (", compression x{:.2f}".format(result['compression_ratio'])
+                               if 'compression_ratio' in result else ''))
+                        results.append(result)
+    finally:
+        os.chdir(working_folder)
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    return results
+
+
+def get_environment() -> dict:
+    """Describes the version of the code and the machine, so results of different runs can be told apart."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return dict(commit=commit,
+                time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                machine=platform.machine(),
+                processor=platform.processor(),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                pandas=pd.__version__)
+
+
+def compare(results: List[dict], baseline: List[dict]):
+    """Prints the ratio of minimal times of matching benchmarks, above 1 means slower than the baseline."""
+    def key(result):
+        return result['name'], result['sample_rate'], result['channels_num'], result['duration']
+    baseline_times = {key(result): result['min'] for result in baseline}
+    for result in results:
+        baseline_time = baseline_times.get(key(result))
+        if baseline_time:
+            print("{:>28} {:>8} Hz {:>2} ch {:>3} s: x{:.2f}".format(*key(result), result['min'] / baseline_time))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Benchmarks of generators, conversion, calibration and I/O.")
+    parser.add_argument('--rates', type=int, nargs='+', default=BENCHMARK_SAMPLE_RATES, help="sample rates, Hz")
+    parser.add_argument('--channels', type=int, nargs='+', default=BENCHMARK_CHANNELS, help="channel counts")
+    parser.add_argument('--durations', type=int, nargs='+', default=BENCHMARK_DURATIONS,
+                        help="profile durations, s")
+    parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS, help="timed calls per benchmark")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="benchmarks to run, all by default")
+    parser.add_argument('--output', help="JSON file with results, a new file in the benchmarks folder by default")
+    parser.add_argument('--compare', help="JSON file with results of another version")
+    args = parser.parse_args()
+
+    _results = run_benchmarks(args.rates, args.channels, args.durations, args.repeats, args.only)
+
+    _output = args.output
+    if _output is None:
+        if not os.path.exists(BENCHMARK_FOLDER_REL_PATH):
+            os.makedirs(BENCHMARK_FOLDER_REL_PATH)
+        _output = os.path.join(BENCHMARK_FOLDER_REL_PATH, time.strftime(BENCHMARK_FILE_FORMAT))
+    with open(_output, 'w') as f:
+        json.dump(dict(environment=get_environment(), results=_results), f, indent=4)
+    print("Results are saved to {}".format(_output))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(_results, json.load(f)['results'])
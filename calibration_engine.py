@@ -0,0 +1,186 @@
+from calibration import Calibration
+from data_writer import BlockStage
+from constants import CALIBRATED_DATA_DATASET
+
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr as ne
+except ImportError:  # optional, plain numpy is used without it
+    ne = None
+
+CALIBRATED_COLUMNS = ['Taux', 'temp', 'temp-hr', 'Thtr', 'Uhtr']
+
+# AI channel positions (relative to the low AI channel)
+IHTR_CHANNEL = 0  # heater current
+UMOD_CHANNEL = 1  # modulation thermopile, amplified by 121
+UAUX_CHANNEL = 3  # AD595 output, 10 mV/C
+UTPL_CHANNEL = 4  # thermopile, amplified by 11
+UHTR_CHANNEL = 5  # heater voltage
+
+UTPL_SCALE = 1000. / 11.  # to mV with the respect of amplification factor of 11
+UMOD_SCALE = 1000. / 121.  # to mV; why 121?? amplifier cascade??
+
+
+def aux_temperature(uaux: float) -> float:
+    """Converts AD595 voltage to temperature, C."""
+    taux = 100. * uaux
+    if taux < -12.:  # correction for AD595 below -12 C
+        taux = 2.6843 + 1.2709 * taux + 0.0042867 * taux * taux + 3.4944e-05 * taux * taux * taux
+    return taux
+
+
+def thermopile_temperature(utpl: np.ndarray, calibration: Calibration, taux: float) -> np.ndarray:
+    """Converts the amplified thermopile voltage (V) to temperature, C."""
+    utpl = utpl * UTPL_SCALE + calibration.utpl0
+    return utpl * (calibration.ttpl0 + calibration.ttpl1 * utpl) + taux
+
+
+class CalibrationEngine:
+    """Turns raw AI channels into calibrated Taux, temp, temp-hr, Thtr and Uhtr columns.
+
+    Every formula is evaluated in Horner form straight into one preallocated output array, with a single
+    scratch array for intermediate values. If numexpr is available, each column is evaluated by it
+    in one fused multi-threaded pass.
+    """
+
+    def __init__(self, calibration: Calibration, use_numexpr: bool = True):
+        self._calibration = calibration
+        self._use_numexpr = use_numexpr and ne is not None
+
+    def apply(self, raw: np.ndarray, index: Optional[pd.Index] = None, taux: Optional[float] = None) -> pd.DataFrame:
+        """Calibrates raw data.
+
+        Args:
+            raw: A (samples, channels) array of AI voltages, channels counted from the low AI channel.
+            index: Index of the resulting DataFrame.
+            taux: Aux temperature, C. Mean of the Uaux channel over the given data by default.
+
+        Returns:
+            DataFrame with CALIBRATED_COLUMNS, sharing memory with the output array.
+        """
+        if taux is None:
+            taux = aux_temperature(float(raw[:, UAUX_CHANNEL].mean()))
+        return pd.DataFrame(self.calibrate(raw, taux), index=index, columns=CALIBRATED_COLUMNS, copy=False)
+
+    def calibrate(self, raw: np.ndarray, taux: float, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Calibrates raw data into a (samples, CALIBRATED_COLUMNS) array.
+
+        Args:
+            raw: A (samples, channels) array of AI voltages, channels counted from the low AI channel.
+            taux: Aux temperature, C.
+            out: Column-major array to write the result to, allocated if not given.
+        """
+        if out is None:
+            # column-major, so every column is contiguous and a DataFrame wraps it without copy
+            out = np.empty((len(raw), len(CALIBRATED_COLUMNS)), order='F')
+        out[:, 0] = taux
+        if self._use_numexpr:
+            self._evaluate_numexpr(raw, out, taux)
+        else:
+            self._evaluate_numpy(raw, out, taux)
+        return out
+
+    def _coeffs(self) -> dict:
+        c = self._calibration
+        return dict(utpl0=c.utpl0, ttpl0=c.ttpl0, ttpl1=c.ttpl1,
+                    thtr0=c.thtr0, thtr1=c.thtr1, thtr2=c.thtr2, thtrcorr=c.thtrcorr,
+                    uhtr0=c.uhtr0, uhtr1=c.uhtr1, ihtr0=c.ihtr0, ihtr1=c.ihtr1,
+                    utpl_scale=UTPL_SCALE, umod_scale=UMOD_SCALE)
+
+    def _evaluate_numexpr(self, raw: np.ndarray, out: np.ndarray, taux: float):
+        variables = self._coeffs()
+        variables.update(taux=taux, uaux=raw[:, UAUX_CHANNEL], utpl=raw[:, UTPL_CHANNEL],
+                         umod=raw[:, UMOD_CHANNEL], ihtr=raw[:, IHTR_CHANNEL], uhtr=raw[:, UHTR_CHANNEL])
+
+        # Utpl or temp - temperature of the calibrated internal thermopile + Taux
+        ne.evaluate("(utpl * utpl_scale + utpl0) * (ttpl0 + ttpl1 * (utpl * utpl_scale + utpl0)) + taux",
+                    local_dict=variables, out=out[:, 1])
+        # temp-hr, modulation thermopile
+        ne.evaluate("(umod * umod_scale + utpl0) * (ttpl0 + ttpl1 * (umod * umod_scale + utpl0))",
+                    local_dict=variables, out=out[:, 2])
+        # Rhtr + thtrcorr, 0 where there is no current
+        ne.evaluate("where(ihtr0 + ihtr * ihtr1 != 0, "
+                    "(uhtr * 1000. - ihtr * 1000. + uhtr0) * uhtr1 / (ihtr0 + ihtr * ihtr1), 0.) + thtrcorr",
+                    local_dict=variables, out=out[:, 3])
+        variables.update(r=out[:, 3])
+        ne.evaluate("thtr0 + r * (thtr1 + thtr2 * r)", local_dict=variables, out=out[:, 3])
+        ne.evaluate("uhtr * 1000.", local_dict=variables, out=out[:, 4])  # Uhtr mV
+
+    def _evaluate_numpy(self, raw: np.ndarray, out: np.ndarray, taux: float):
+        c = self._calibration
+        tmp = np.empty(len(raw))
+
+        # Utpl or temp - temperature of the calibrated internal thermopile + Taux
+        temp = out[:, 1]
+        np.multiply(raw[:, UTPL_CHANNEL], UTPL_SCALE, out=temp)
+        temp += c.utpl0
+        np.multiply(temp, c.ttpl1, out=tmp)
+        tmp += c.ttpl0
+        temp *= tmp
+        temp += taux
+
+        # temp-hr, modulation thermopile
+        temp_hr = out[:, 2]
+        np.multiply(raw[:, UMOD_CHANNEL], UMOD_SCALE, out=temp_hr)
+        temp_hr += c.utpl0
+        np.multiply(temp_hr, c.ttpl1, out=tmp)
+        tmp += c.ttpl0
+        temp_hr *= tmp
+
+        # Uhtr mV
+        uhtr = out[:, 4]
+        np.multiply(raw[:, UHTR_CHANNEL], 1000., out=uhtr)
+
+        # Rhtr, 0 where there is no current, then Thtr
+        thtr = out[:, 3]
+        np.multiply(raw[:, IHTR_CHANNEL], c.ihtr1, out=tmp)
+        tmp += c.ihtr0
+        np.multiply(raw[:, IHTR_CHANNEL], -1000., out=thtr)
+        thtr += uhtr
+        thtr += c.uhtr0
+        thtr *= c.uhtr1
+        no_current = tmp == 0
+        np.divide(thtr, tmp, out=thtr, where=~no_current)
+        thtr[no_current] = 0.
+        thtr += c.thtrcorr
+        np.multiply(thtr, c.thtr2, out=tmp)
+        tmp += c.thtr1
+        thtr *= tmp
+        thtr += c.thtr0
+
+
+class StreamingCalibration(BlockStage):
+    """Calibrates every block as soon as it is stored, appending the result to the calibrated dataset.
+
+    Taux can't be a mean of the whole run before the run ends, so the running mean of Uaux
+    over all blocks processed so far is used for each block.
+    """
+
+    def __init__(self, calibration: Calibration, use_numexpr: bool = True):
+        self._engine = CalibrationEngine(calibration, use_numexpr)
+        self._store = None
+        self._out = None
+        self._uaux_sum = 0.
+        self._samples_num = 0
+
+    def start(self, store):
+        self._store = store
+        self._store.create_dataset(CALIBRATED_DATA_DATASET, len(CALIBRATED_COLUMNS), CALIBRATED_COLUMNS)
+        self._out = None
+        self._uaux_sum = 0.
+        self._samples_num = 0
+
+    def process_block(self, rows: np.ndarray, block_index: int):
+        self._uaux_sum += float(rows[:, UAUX_CHANNEL].sum())
+        self._samples_num += len(rows)
+        taux = aux_temperature(self._uaux_sum / self._samples_num)
+
+        if self._out is None or len(self._out) != len(rows):
+            self._out = np.empty((len(rows), len(CALIBRATED_COLUMNS)), order='F')
+        self._store.write_rows(CALIBRATED_DATA_DATASET, self._engine.calibrate(rows, taux, self._out), block_index)
+
+    def finish(self):
+        self._store = None
@@ -14,9 +14,53 @@ RAW_DATA_FOLDER = "raw_data"
 RAW_DATA_FOLDER_REL_PATH = os.path.join(DATA_FOLDER_REL_PATH, RAW_DATA_FOLDER)
 RAW_DATA_FILE = "raw_data.h5"
 RAW_DATA_FILE_REL_PATH = os.path.join(RAW_DATA_FOLDER_REL_PATH, RAW_DATA_FILE)
+RAW_DATA_DATASET = "dataset"
+CALIBRATED_DATA_DATASET = "calibrated"
+LOCK_IN_DATASET = "lock_in"
 
-RAW_DATA_BUFFER_FILE_PREFIX = "raw_data_buffer_"
-RAW_DATA_BUFFER_FILE_FORMAT = "raw_data_buffer_{}.h5"
+SEQUENCE_FOLDER = "sequences"
+SEQUENCE_FOLDER_REL_PATH = os.path.join(DATA_FOLDER_REL_PATH, SEQUENCE_FOLDER)
+SEQUENCE_FILE_FORMAT = "sequence_%Y%m%d_%H%M%S.h5"  # time.strftime format
+SEQUENCE_RUN_GROUP = "run_{:04d}"
+
+WRITER_QUEUE_SIZE = 8  # number of half-buffers the background writer can lag behind the acquisition
+DEFAULT_AI_BUFFER_TIME = 1.  # s, circular AI buffer if BufferTime is not set
+AI_BUFFER_MIN_TIME = 0.1  # s, shortest adaptive AI buffer, bounds the number of half-buffer flips per second
+AI_BUFFER_MAX_SIZE = 256 * 1024 ** 2  # bytes, longest adaptive AI buffer
+AI_BUFFER_DEFAULT_LATENCY = 0.05  # s, read loop latency assumed for the adaptive AI buffer before the first run
+AI_BUFFER_LATENCY_FACTOR = 4.  # half of the adaptive AI buffer lasts that many measured read loop latencies
+
+# Run metrics constants
+# =================================================================================
+HISTOGRAM_LOW = 1e-5  # s, lower edge of latency histograms
+HISTOGRAM_HIGH = 10.  # s, upper edge of latency histograms
+HISTOGRAM_BINS_PER_DECADE = 4
+METRICS_ATTR = "metrics"  # JSON attribute of the raw dataset with metrics of the run
+
+# Benchmark constants
+# =================================================================================
+BENCHMARK_FOLDER = "benchmarks"
+BENCHMARK_FOLDER_REL_PATH = os.path.join(DATA_FOLDER_REL_PATH, BENCHMARK_FOLDER)
+BENCHMARK_FILE_FORMAT = "benchmark_%Y%m%d_%H%M%S.json"  # time.strftime format
+BENCHMARK_SAMPLE_RATES = [20000, 100000, 1000000]  # Hz
+BENCHMARK_CHANNELS = [2, 6]
+BENCHMARK_DURATIONS = [1, 5]  # s
+BENCHMARK_REPEATS = 5
+
+# Fast heating states
+# =================================================================================
+FH_IDLE_STATE = "IDLE"  # nothing is armed
+FH_ARMED_STATE = "ARMED"
+FH_RUNNING_STATE = "RUNNING"
+FH_FINISHING_STATE = "FINISHING"  # acquisition is over, queued data is being stored
+FH_DONE_STATE = "DONE"
+FH_FAULT_STATE = "FAULT"
+
+# Live preview constants
+# =================================================================================
+PREVIEW_POINTS_PER_BLOCK = 100  # min/max points per channel each AI half-buffer is reduced to
+PREVIEW_HISTORY = 10.  # s, time kept in the preview ring buffer
+PREVIEW_MAX_POINTS = 100000  # maximal length of preview spectrum attributes
 
 # Logs constants
 # =================================================================================
@@ -40,6 +84,7 @@ DAQ_FIELD = "DAQ"
 AI_FIELD = "AI"
 AO_FIELD = "AO"
 
+BACKEND_FIELD = "Backend"
 INTERFACE_TYPE_FIELD = "InterfaceType"
 CONNECTION_CODE_FIELD = "ConnectionCode"
 
@@ -49,12 +94,60 @@ LOW_CHANNEL_FIELD = "LowChannel"
 HIGH_CHANNEL_FIELD = "HighChannel"
 INPUT_MODE_FIELD = "InputMode"
 SCAN_FLAGS_FIELD = "ScanFlags"
+WAIT_MODE_FIELD = "WaitMode"
+BUFFER_TIME_FIELD = "BufferTime"
+STREAM_BUFFER_FIELD = "StreamBuffer"
+TEMPERATURE_CONVERSION_FIELD = "TemperatureConversion"
+STORAGE_FIELD = "Storage"
+COMPRESSION_FIELD = "Compression"
+COMPRESSION_LEVEL_FIELD = "CompressionLevel"
+SHUFFLE_FIELD = "Shuffle"
+KEEP_RAW_DATA_FIELD = "KeepRawData"
+
+# DAQ backends
+ULDAQ_BACKEND = "uldaq"
+SIMULATED_BACKEND = "simulated"
+DAQ_BACKENDS = [ULDAQ_BACKEND, SIMULATED_BACKEND]
+
+# AI read loop wait modes
+EVENT_WAIT_MODE = "event"  # uldaq data events, sleep if the device doesn't support them
+SLEEP_WAIT_MODE = "sleep"  # sleep until the expected half-buffer boundary
+POLL_WAIT_MODE = "poll"  # busy polling of the scan status
+WAIT_MODES = [EVENT_WAIT_MODE, SLEEP_WAIT_MODE, POLL_WAIT_MODE]
+
+AUTO_BUFFER_TIME = "auto"  # AI buffer sized from the sample rate, channels and measured latency
+
+# HDF5 compression of stored data, compression is a PyTables complib like "blosc:lz4" or "zlib"
+NO_COMPRESSION = "none"
+DEFAULT_COMPRESSION_LEVEL = 5  # 0 - 9
+NO_SHUFFLE = "none"
+BYTE_SHUFFLE = "byte"  # groups bytes of equal significance of neighbouring values
+BIT_SHUFFLE = "bit"  # groups bits of equal significance, best for slowly varying signals, blosc only
+SHUFFLE_MODES = [NO_SHUFFLE, BYTE_SHUFFLE, BIT_SHUFFLE]
+
+# AO constants
+# =================================================================================
+DEFAULT_STREAM_BUFFER = 1.  # s, circular AO buffer of streamed profiles if StreamBuffer is not set
+AO_BUFFER_CACHE_BUDGET = 256 * 1024 ** 2  # bytes of armed AO buffers kept for identical protocols
+
+# AO buffer store constants
+# =================================================================================
+AO_BUFFER_STORE_FOLDER = "ao_buffers"
+AO_BUFFER_STORE_FOLDER_REL_PATH = os.path.join(".", "cache", AO_BUFFER_STORE_FOLDER)
+CALIBRATION_FINGERPRINT_FILE = "calibration.sha256"
 
 # Calibration constants
 # =================================================================================
 CALIBRATION_PATH = "./settings/calibration.json"
 DEFAULT_CALIBRATION_PATH = "./settings/default_calibration.json"
 
+# temperature to voltage conversion modes
+LOOKUP_CONVERSION = "lookup"  # table of Theater(U) values
+NEWTON_CONVERSION = "newton"  # exact inversion of the Theater polynomial
+CONVERSION_MODES = [LOOKUP_CONVERSION, NEWTON_CONVERSION]
+
+MODULATION_TABLE_MAX_SAMPLES = 1000000  # samples of the precomputed modulation table, a whole number of periods
+
 INFO_FIELD = "Info"
 
 MODULATION_PARAMS_FIELD = "Modulation params"
@@ -1,12 +1,16 @@
+from ai_device import AiDeviceHandler, AiParams
+from ao_device import AoDeviceHandler, AoParams
+from constants import ULDAQ_BACKEND, SIMULATED_BACKEND
+
+from typing import Callable, List, Optional
 import uldaq as ul
 import logging
 import time
 
-# TODO: add an abstract class for device + add a mock device for testing
-
 
 class DaqParams:
     def __init__(self):
+        self.backend = ULDAQ_BACKEND
         self.interface_type = ul.InterfaceType.ANY  # 7
         self.connection_code = -1
 
@@ -15,11 +19,22 @@ class DaqParams:
 
 
 class DaqDeviceHandler:
+    """Wraps the uldaq.DaqDevice and owns AI and AO handlers for the lifetime of the connection."""
+
     def __init__(self, params: DaqParams):
         self._params = params
+        self._ai_device_handler: Optional[AiDeviceHandler] = None
+        self._ao_device_handler: Optional[AoDeviceHandler] = None
+        self._event_types: Optional[List[ul.DaqEventType]] = None
         self._init_daq_device()
 
     def _init_daq_device(self):
+        if self._params.backend == SIMULATED_BACKEND:
+            from sim_device import SimDaqDevice
+            logging.info("DAQ DEVICE: Using simulated DAQ device.")
+            self._daq_device = SimDaqDevice()
+            return
+
         devices = ul.get_daq_device_inventory(self._params.interface_type, 1)  # we expect only one device for now
         if not devices:
             error_str = "No DAQ devices found."
@@ -63,14 +78,17 @@ class DaqDeviceHandler:
         raise TimeoutError("DAQ DEVICE: Connection timed out.")
 
     def disconnect(self):
+        self._drop_handlers()
         self._daq_device.disconnect()
         logging.info("DAQ DEVICE: DAQ device has been disconnected.")
 
     def release(self):
+        self._drop_handlers()
         self._daq_device.release()
         logging.info("DAQ DEVICE: DAQ device has been released.")
 
     def reset(self):
+        self._drop_handlers()
         self._daq_device.reset()
         logging.info("DAQ DEVICE: DAQ device has been reset.")
 
@@ -81,6 +99,19 @@ class DaqDeviceHandler:
         self.release()
         logging.info("DAQ DEVICE: DAQ device has been disconnected and released.")
 
+    def get_event_types(self) -> List[ul.DaqEventType]:
+        # device capabilities don't change while connected
+        if self._event_types is None:
+            self._event_types = self._daq_device.get_info().get_event_types()
+        return self._event_types
+
+    def enable_event(self, event_types: ul.DaqEventType, event_parameter: int,
+                     event_callback_function: Callable[[ul.EventCallbackArgs], None], user_data: object):
+        self._daq_device.enable_event(event_types, event_parameter, event_callback_function, user_data)
+
+    def disable_event(self, event_types: ul.DaqEventType):
+        self._daq_device.disable_event(event_types)
+
     def get(self) -> ul.DaqDevice:
         return self._daq_device
 
@@ -89,3 +120,39 @@ class DaqDeviceHandler:
 
     def get_ao_device(self) -> ul.AoDevice:
         return self._daq_device.get_ao_device()
+
+    def get_ai_device_handler(self, params: AiParams) -> AiDeviceHandler:
+        """Provides the AI handler, created at the first call after connecting and reused by later runs.
+
+        Args:
+            params: AiParams of the next scan, the AI buffer is reallocated only if its size changed.
+
+        Raises:
+            RuntimeError if the DAQ device doesn't support analog input or hardware paced analog input.
+        """
+        if self._ai_device_handler is None:
+            self._ai_device_handler = AiDeviceHandler(self.get_ai_device(), params)
+        else:
+            self._ai_device_handler.set_params(params)
+        return self._ai_device_handler
+
+    def get_ao_device_handler(self, params: AoParams) -> AoDeviceHandler:
+        """Provides the AO handler, created at the first call after connecting and reused by later runs.
+
+        Args:
+            params: AoParams of the next scan.
+
+        Raises:
+            RuntimeError if the DAQ device doesn't support analog output or hardware paced analog output.
+        """
+        if self._ao_device_handler is None:
+            self._ao_device_handler = AoDeviceHandler(self.get_ao_device(), params)
+        else:
+            self._ao_device_handler.set_params(params)
+        return self._ao_device_handler
+
+    def _drop_handlers(self):
+        # uldaq device objects are not valid after disconnecting
+        self._ai_device_handler = None
+        self._ao_device_handler = None
+        self._event_types = None
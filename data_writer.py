@@ -0,0 +1,145 @@
+from typing import Callable, Optional
+import threading
+import logging
+import queue
+import time
+
+import numpy as np
+
+from metrics import Histogram
+from constants import WRITER_QUEUE_SIZE
+
+
+class AcquisitionOverrunError(RuntimeError):
+    """Raised when acquired data cannot be taken from the DAQ buffer before it is overwritten."""
+    pass
+
+
+class BlockStage:
+    """Base class of processing stages, run by the writer thread on every stored block."""
+
+    def start(self, store):
+        """Called before the acquisition with the RawDataStore of the run, e.g. to create own datasets."""
+        pass
+
+    def process_block(self, rows: np.ndarray, block_index: int):
+        """Processes one block of (samples, channels) AI data. Must not keep a reference to rows."""
+        pass
+
+    def finish(self):
+        """Called after the last block is processed, also for aborted runs."""
+        pass
+
+
+class BlockWriter:
+    """Writes acquired blocks in a background thread, so slow storage doesn't stall buffer polling.
+
+    The producer copies each block into one of the preallocated blocks of a bounded pool and enqueues it.
+    If no free block appears within the timeout, the writer is considered too slow and
+    AcquisitionOverrunError is raised instead of silently losing data.
+    """
+
+    def __init__(self, block_len: int, write_block: Callable[[np.ndarray, int], None],
+                 timeout: float, queue_size: int = WRITER_QUEUE_SIZE, dtype=np.float64):
+        """Allocates blocks and starts the writer thread.
+
+        Args:
+            block_len: Number of values in one block.
+            write_block: Function storing one block, gets the block and its index.
+            timeout: Maximal time (s) the producer can wait for a free block.
+            queue_size: Number of preallocated blocks.
+            dtype: Type of block values, e.g. integer for ADC counts, put data is converted to it.
+        """
+        self._write_block = write_block
+        self._timeout = timeout
+        self._queue_size = queue_size
+
+        self._free_blocks = queue.Queue()
+        for _ in range(queue_size):
+            self._free_blocks.put(np.empty(block_len, dtype=dtype))
+        self._filled_blocks = queue.Queue()
+        self._error: Optional[BaseException] = None
+
+        self._max_queue_depth = 0
+        self._queue_depth_sum = 0
+        self._blocks_put = 0
+        self._backpressure_count = 0
+        self._blocks_written = 0
+        self._write_times = Histogram()
+
+        self._thread = threading.Thread(target=self._write_loop, name="BlockWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, data: np.ndarray, index: int):
+        """Copies data into a free block and enqueues it for writing.
+
+        Raises:
+            AcquisitionOverrunError if no block was freed within the timeout.
+            RuntimeError if writing of a previous block failed.
+        """
+        self._raise_if_failed()
+        try:
+            block = self._free_blocks.get_nowait()
+        except queue.Empty:
+            self._backpressure_count += 1
+            logging.warning("WRITER: WARNING. All {} blocks are busy, waiting for the writer.".format(self._queue_size))
+            try:
+                block = self._free_blocks.get(timeout=self._timeout)
+            except queue.Empty:
+                error_str = "Data overrun. Block {} cannot be queued, writer is {} blocks behind " \
+                            "for more than {:.3f} s.".format(index, self._queue_size, self._timeout)
+                logging.error("WRITER: ERROR. {}".format(error_str))
+                raise AcquisitionOverrunError(error_str)
+
+        # raw ADC counts come from the board as whole float64 values
+        np.copyto(block, data, casting='unsafe')
+        self._filled_blocks.put((block, index))
+        queue_depth = self._filled_blocks.qsize()
+        self._max_queue_depth = max(self._max_queue_depth, queue_depth)
+        self._queue_depth_sum += queue_depth
+        self._blocks_put += 1
+
+    def close(self):
+        """Waits until all queued blocks are written and stops the thread.
+
+        Raises:
+            RuntimeError if writing of any block failed.
+        """
+        self._filled_blocks.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+    def get_queue_depth(self) -> int:
+        return self._filled_blocks.qsize()
+
+    def get_metrics(self) -> dict:
+        return dict(queue_size=self._queue_size,
+                    queue_depth=self.get_queue_depth(),
+                    max_queue_depth=self._max_queue_depth,
+                    mean_queue_depth=self._queue_depth_sum / self._blocks_put if self._blocks_put else 0.,
+                    backpressure_count=self._backpressure_count,
+                    blocks_written=self._blocks_written,
+                    mean_write_time=self._write_times.get_mean(),
+                    max_write_time=self._write_times.get_max(),
+                    write_time=self._write_times.to_dict())
+
+    def _write_loop(self):
+        while True:
+            item = self._filled_blocks.get()
+            if item is None:
+                break
+            block, index = item
+            if self._error is None:
+                try:
+                    start = time.perf_counter()
+                    self._write_block(block, index)
+                    self._write_times.add(time.perf_counter() - start)
+                    self._blocks_written += 1
+                except BaseException as e:
+                    logging.error("WRITER: ERROR. Writing of block {} failed: {}".format(index, e))
+                    self._error = e
+            self._free_blocks.put(block)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Writing of acquired data failed: {}".format(self._error))
@@ -1,87 +1,233 @@
 from daq_device import DaqDeviceHandler
 from ai_device import AiDeviceHandler
 from ao_device import AoDeviceHandler
-from ao_data_generators import ScanDataGenerator
+from ao_data_generators import ScanDataGenerator, StreamDataGenerator, get_profile_length
+from ao_streamer import AoStreamer
+from data_writer import BlockWriter, BlockStage
+from raw_data_store import RawDataStore
+from scan_waiter import create_scan_waiter
 from settings import SettingsParser
-from constants import (RAW_DATA_FOLDER_REL_PATH, RAW_DATA_FILE_REL_PATH, RAW_DATA_BUFFER_FILE_FORMAT,
-                       RAW_DATA_BUFFER_FILE_PREFIX)
+from metrics import Histogram
+from utils import deinterleave
+from constants import RAW_DATA_FOLDER_REL_PATH, RAW_DATA_FILE_REL_PATH, RAW_DATA_DATASET, DEFAULT_STREAM_BUFFER, \
+    METRICS_ATTR
 
-from typing import List
+from typing import List, Optional
 from ctypes import Array
+import numpy as np
 import pandas as pd
 import uldaq as ul
+import tables
+import threading
+import json
+import time
 import os
-import glob
 import logging
 
-# TODO: check why we create analog devices inside scanning methods
-
 
 class ExperimentManager:
-    _ai_device_handler: AiDeviceHandler
-    _ao_device_handler: AoDeviceHandler
     _ao_buffer: Array[float]
 
     def __init__(self, daq_device_handler: DaqDeviceHandler,
                  voltage_profiles: dict,
-                 settings_parser: SettingsParser):
+                 settings_parser: SettingsParser,
+                 samples_per_channel: Optional[int] = None,
+                 ao_buffer: Optional[Array[float]] = None,
+                 abort_event: Optional[threading.Event] = None):
+        """Initializes the manager of experiment runs.
+
+        The manager can make several runs, keeping device handlers and buffers, see set_profiles.
+
+        Args:
+            daq_device_handler: Connected DaqDeviceHandler.
+            voltage_profiles: Voltages for each used AO channel like {'ch0': [.......], 'ch3': [........]}.
+                Streamed profiles can also be functions getting arrays of sample indices.
+            settings_parser: SettingsParser with AI and AO parameters.
+            samples_per_channel: Profile length, length of array profiles by default.
+            ao_buffer: Interleaved AO buffer, already built from the profiles, e.g. taken from a cache.
+            abort_event: Event aborting the runs, owned by the caller, so an abort requested before a run started
+                is not lost. Runs don't clear it. A new one by default.
+        """
         self._daq_device_handler = daq_device_handler
         self._voltage_profiles = voltage_profiles
+        self._samples_per_channel = samples_per_channel
+        self._armed_ao_buffer = ao_buffer
         self._ai_params = settings_parser.get_ai_params()
         self._ao_params = settings_parser.get_ao_params()
+        self._storage_params = settings_parser.get_storage_params()
+        # handlers are owned by the DAQ device handler, they are taken for every run
+        self._ai_device_handler: Optional[AiDeviceHandler] = None
+        self._ao_device_handler: Optional[AoDeviceHandler] = None
+        self._ao_streamer: Optional[AoStreamer] = None
+        self._results_file: Optional[tables.File] = None
+        self._results_group: Optional[str] = None
+        self._writer_metrics = dict()
+        self._wait_metrics = dict()
+        self._stream_metrics = dict()
+        self._setup_metrics = dict()
+        self._scan_metrics = dict()
+        self._bytes_written = 0
+        self._bytes_on_disk = 0
+        self._setup_start_time = None
+        self._stages: List[BlockStage] = []
+        self._run_attrs = dict()
+        self._keep_raw_data = self._storage_params.keep_raw_data
+        self._abort_event = abort_event if abort_event is not None else threading.Event()
+        self._is_finishing = False
+        self._buffer_index = 0
+        self._buffers_num = 0
+        self._values_read = 0
+        self._overrun_values = 0
+        self._loop_start_time = None
 
-        ExperimentManager._do_smth_strange()  # TODO: check and try to avoid this action
+    def set_profiles(self, voltage_profiles: dict, samples_per_channel: Optional[int] = None,
+                     ao_buffer: Optional[Array[float]] = None):
+        """Sets profiles of the next run, see __init__. Device handlers and the AI buffer are kept."""
+        self._voltage_profiles = voltage_profiles
+        self._samples_per_channel = samples_per_channel
+        self._armed_ao_buffer = ao_buffer
 
-    @staticmethod
-    def _do_smth_strange():
-        # Strange, but the first invoke of pandas.to_hdf takes a lot of time.
-        # So in order not to lose points during acquisition, we invoke it here with empty dataframe
-        df = pd.DataFrame([])
-        df.to_hdf(RAW_DATA_FILE_REL_PATH, key='dataset', format='table', append=True, mode='a')
-
-        # before starting, removing the previous generated files with data from separated buffers
-        h5_files_to_remove_regex = RAW_DATA_FOLDER_REL_PATH + '/' + RAW_DATA_BUFFER_FILE_PREFIX + "*.h5"
-
-        h5_files = glob.glob(h5_files_to_remove_regex, recursive=True)
-        h5_files.append(RAW_DATA_FILE_REL_PATH)
-        for file in h5_files:
-            try:
-                os.remove(file)
-            except:
-                pass
+    def set_results_group(self, results_file: tables.File, group: str):
+        """Makes the next runs write their datasets into the group of an open file instead of the raw data file."""
+        self._results_file = results_file
+        self._results_group = group
+
+    def reset_run(self):
+        """Removes stages and run attributes, added for the previous run."""
+        self._stages = []
+        self._run_attrs = dict()
+
+    def add_stage(self, stage: BlockStage):
+        """Adds a stage, processing every stored AI block while the acquisition is still running."""
+        self._stages.append(stage)
+
+    def add_run_attrs(self, **attrs):
+        """Adds parameters of the run, e.g. the modulation reference, saved as attributes of the raw data."""
+        self._run_attrs.update(attrs)
 
     def get_ai_data(self, ai_channels: List[int]) -> pd.DataFrame:
-        df = pd.DataFrame(pd.read_hdf(RAW_DATA_FILE_REL_PATH, key='dataset'))
-
-        channels_num = self._ai_params.high_channel - self._ai_params.low_channel + 1
-        one_chan_len = int(len(df) / channels_num)
-        multi_index = pd.MultiIndex.from_product([list(range(one_chan_len)), list(range(channels_num))])
-        df.index = multi_index
-        df = df.unstack()
-        df.columns = df.columns.droplevel()
-        df = df[ai_channels]
-        return df
-    
+        """Reads acquired data of the selected AI channels, indexed by time in ms.
+
+        The raw data is already stored deinterleaved, one column per channel, so only the selected columns
+        are read and the frame wraps them without another copy. Raw ADC counts are converted to volts here.
+        """
+        data = RawDataStore.read(RAW_DATA_FILE_REL_PATH, ai_channels)
+        time_index = pd.Index(np.arange(len(data)) * (1000. / self._ai_params.sample_rate), name='time')
+        return pd.DataFrame(data, index=time_index, columns=ai_channels, copy=False)
+
+    @staticmethod
+    def get_dataset(name: str, columns: List[str], sample_rate: int) -> pd.DataFrame:
+        """Reads a dataset written by a processing stage, indexed by time in ms."""
+        data = RawDataStore.read(RAW_DATA_FILE_REL_PATH, name=name)
+        time_index = pd.Index(np.arange(len(data)) * (1000. / sample_rate), name='time')
+        return pd.DataFrame(data, index=time_index, columns=columns, copy=False)
+
+    def get_metrics(self) -> dict:
+        """Provides all metrics of the last run: setup times, achieved scan rates, the AI read loop,
+        the data writer, the AO streamer and the size of the written data."""
+        return dict(setup=self._setup_metrics,
+                    scan=self._scan_metrics,
+                    read_loop=self._wait_metrics,
+                    writer=self._writer_metrics,
+                    stream=self._ao_streamer.get_metrics() if self._ao_streamer is not None else self._stream_metrics,
+                    store=dict(compression=self._storage_params.compression,
+                               bytes_written=self._bytes_written,
+                               bytes_on_disk=self._bytes_on_disk,
+                               compression_ratio=self._bytes_written / self._bytes_on_disk
+                               if self._bytes_on_disk else 0.))
+
+    def get_progress(self) -> dict:
+        """Provides the number of acquired and expected AI buffers and the data rate (AI values per second).
+
+        Can be called from any thread during the run. finishing is True when the acquisition is over
+        and the queued data is being stored.
+        """
+        elapsed = time.perf_counter() - self._loop_start_time if self._loop_start_time is not None else 0.
+        return dict(buffer_index=self._buffer_index,
+                    buffers_num=self._buffers_num,
+                    data_rate=self._values_read / elapsed if elapsed > 0 else 0.,
+                    finishing=self._is_finishing)
+
+    def abort(self):
+        """Stops the run from any thread within a half of the AI buffer, the AO outputs are set to 0 V.
+
+        Runs started later are aborted too, until the owner of the abort event clears it.
+        """
+        logging.warning('WARNING. Run abort requested.')
+        self._abort_event.set()
+
+    def is_aborted(self) -> bool:
+        return self._abort_event.is_set()
+
     def run(self):
-        self._ao_scan()
-        self._ai_continuous(do_save_data=True)
+        if self._samples_per_channel is None:
+            self._samples_per_channel = get_profile_length(self._voltage_profiles)
+        self._is_finishing = False
+        self._setup_start_time = time.perf_counter()
+        self._setup_metrics = dict()
+        self._scan_metrics = dict()
+        self._wait_metrics = dict()
+        self._writer_metrics = dict()
+        self._stream_metrics = dict()
+        self._bytes_written = 0
+        self._bytes_on_disk = 0
+
+        try:
+            if self._is_streamed():
+                self.ao_continuous(self._voltage_profiles, self._samples_per_channel)
+            else:
+                self._ao_scan()
+            self._ai_continuous(do_save_data=True)
+        except BaseException:
+            self._stop_streaming()
+            self._zero_ao()
+            raise
+        self._stop_streaming()
+        if self.is_aborted():
+            self._zero_ao()
+
+    def _zero_ao(self):
+        # stops the output and makes sure the heater is not left powered
+        if self._ao_device_handler is None:
+            return
+        try:
+            # the profile must not keep playing, single outputs are refused during a scan anyway
+            self._ao_device_handler.stop()
+            for channel in range(self._ao_params.low_channel, self._ao_params.high_channel + 1):
+                self._ao_device_handler.set_voltage(channel, 0.)
+            logging.info('AO outputs are set to 0 V.')
+        except ul.ULException as e:
+            logging.error("ERROR. AO outputs cannot be set to 0 V. Code: {}, message: {}.".format(e.error_code,
+                                                                                                 e.error_message))
+
+    def _is_streamed(self) -> bool:
+        # functions can only be streamed, arrays - if they don't fit into the stream buffer
+        if any(callable(profile) for profile in self._voltage_profiles.values()):
+            return True
+        stream_buffer_samples = self._ao_params.stream_buffer * self._ao_params.sample_rate
+        return 0 < stream_buffer_samples < self._samples_per_channel
 
     # for limited scans (one AO buffer will be applied)
     def _ao_scan(self):
         logging.info("AO SCAN mode. Wait until scan is finished.\n")
         self._ao_params.options = ul.ScanOption.BLOCKIO  # 2
         
-        self._ao_buffer = ScanDataGenerator(self._voltage_profiles,
-                                            self._ao_params.low_channel,
-                                            self._ao_params.high_channel).get_buffer()
+        if self._armed_ao_buffer is not None:
+            self._ao_buffer = self._armed_ao_buffer
+        else:
+            self._ao_buffer = ScanDataGenerator(self._voltage_profiles,
+                                                self._ao_params.low_channel,
+                                                self._ao_params.high_channel).get_buffer()
 
-        self._ao_device_handler = AoDeviceHandler(self._daq_device_handler.get_ao_device(),
-                                                  self._ao_params)
+        self._ao_device_handler = self._daq_device_handler.get_ao_device_handler(self._ao_params)
         # need to stop AO before scan
-        if self._ao_device_handler.status == ul.ScanStatus.RUNNING:
+        status, _ = self._ao_device_handler.status()
+        if status == ul.ScanStatus.RUNNING:
             self._ao_device_handler.stop()
 
-        self._ao_device_handler.scan(self._ao_buffer)
+        ao_rate = self._ao_device_handler.scan(self._ao_buffer)
+        self._set_ao_rate(ao_rate)
+        self._setup_metrics['ao_setup_time'] = time.perf_counter() - self._setup_start_time
 
     # for setting voltage
     def ao_set(self, channel_voltages: dict, duration: int):
@@ -89,79 +235,251 @@ class ExperimentManager:
         # TODO: set specified voltage on selected channels + sine on reference channel
         pass
 
-    # for continuous scans (ao buffer will be repeated)
-    def ao_continuous(self, voltage_profiles: dict):
+    # for long profiles (ao buffer is circular and refilled while being played)
+    def ao_continuous(self, voltage_profiles: dict, samples_num: Optional[int] = None):
+        """Starts streaming of the profiles through a circular AO buffer, so they are played in constant memory.
+
+        Args:
+            voltage_profiles: Voltages for each used AO channel like {'ch0': [.......], 'ch3': function},
+                functions get arrays of sample indices and return voltages.
+            samples_num: Profile length, length of array profiles by default.
+        """
+        logging.info("AO CONTINUOUS mode. Profile is streamed through a circular buffer.\n")
         self._ao_params.options = ul.ScanOption.CONTINUOUS  # 8
-        # TODO: think about difference with ao_set, maybe leave just one of them
-        pass
+        if samples_num is None:
+            samples_num = get_profile_length(voltage_profiles)
+
+        generator = StreamDataGenerator(voltage_profiles, self._ao_params.low_channel,
+                                        self._ao_params.high_channel, samples_num)
+        self._ao_device_handler = self._daq_device_handler.get_ao_device_handler(self._ao_params)
+        # need to stop AO before scan
+        self._stop_streaming()
+        status, _ = self._ao_device_handler.status()
+        if status == ul.ScanStatus.RUNNING:
+            self._ao_device_handler.stop()
+
+        stream_buffer = self._ao_params.stream_buffer or DEFAULT_STREAM_BUFFER
+        samples_per_half = max(int(stream_buffer * self._ao_params.sample_rate / 2), 1)
+        self._ao_streamer = AoStreamer(self._ao_device_handler, generator, samples_per_half,
+                                       self._ao_params.high_channel - self._ao_params.low_channel + 1,
+                                       self._ao_params.sample_rate)
+        ao_rate = self._ao_streamer.start()
+        self._set_ao_rate(ao_rate)
+        if self._setup_start_time is not None:
+            self._setup_metrics['ao_setup_time'] = time.perf_counter() - self._setup_start_time
+
+    def _set_ao_rate(self, ao_rate: float):
+        # the board can run at the nearest rate its clock allows
+        self._scan_metrics.update(ao_requested_rate=self._ao_params.sample_rate, ao_rate=ao_rate)
+        if ao_rate != self._ao_params.sample_rate:
+            logging.warning('WARNING. AO runs at {} Hz instead of {} Hz.'.format(ao_rate, self._ao_params.sample_rate))
+
+    def _stop_streaming(self):
+        if self._ao_streamer is not None:
+            self._ao_streamer.stop()
+            self._stream_metrics = self._ao_streamer.get_metrics()
+            logging.info('AO streamer: {}'.format(self._stream_metrics))
+            self._ao_streamer = None
 
     def _ai_continuous(self, do_save_data: bool):
-        # AI buffer is 1 s and AI is made in loop. AO buffer equals to AO profile length.
+        # AI is made in loop through a circular buffer, see AiParams.buffer_time. AO buffer equals to AO profile length.
         self._ai_params.options = ul.ScanOption.CONTINUOUS  # 8
-        self._ai_device_handler = AiDeviceHandler(self._daq_device_handler.get_ai_device(),
-                                                  self._ai_params)
+        ai_setup_start = time.perf_counter()
+        self._ai_device_handler = self._daq_device_handler.get_ai_device_handler(self._ai_params)
 
         # need to stop acquisition before scan
-        if self._ai_device_handler.status == ul.ScanStatus.RUNNING:
+        status, _ = self._ai_device_handler.status()
+        if status == ul.ScanStatus.RUNNING:
             self._ai_device_handler.stop()
 
-        self._ai_device_handler.scan()
-        self._read_data_loop(do_save_data)
+        # data events have to be enabled before the scan is started
+        ai_channels_num = self._ai_params.high_channel - self._ai_params.low_channel + 1
+        samples_per_half_buffer = int(len(self._ai_device_handler.get_buffer()) / (2 * ai_channels_num))
+        self._scan_waiter = create_scan_waiter(self._ai_params.wait_mode, self._daq_device_handler,
+                                               self._ai_params.sample_rate, ai_channels_num, samples_per_half_buffer)
+        self._scan_waiter.start()
+        try:
+            ai_rate = self._ai_device_handler.scan()
+            self._scan_metrics.update(ai_requested_rate=self._ai_params.sample_rate, ai_rate=ai_rate)
+            if ai_rate != self._ai_params.sample_rate:
+                logging.warning('WARNING. AI runs at {} Hz instead of {} Hz.'.format(ai_rate,
+                                                                                     self._ai_params.sample_rate))
+            self._setup_metrics.update(ai_setup_time=time.perf_counter() - ai_setup_start,
+                                       setup_time=time.perf_counter() - self._setup_start_time,
+                                       ai_buffer_reused=self._ai_device_handler.is_buffer_reused())
+            logging.info('Run setup: {}'.format(self._setup_metrics))
+            self._read_data_loop(do_save_data)
+        finally:
+            self._scan_waiter.stop()
 
         logging.info('Continuous AI finished.')
         
     def _read_data_loop(self, do_save_data: bool):
+        writer = None
+        store = None
+        flip_latencies = Histogram()
+        iterations = 0
+        is_complete = False
         try:
-            tmp_ai_data = self._ai_device_handler.get_buffer()
+            # numpy view over the circular uldaq buffer, each half is copied once into a writer block
+            ai_data = self._ai_device_handler.get_buffer_view()
 
-            is_buffer_high_half = True
-            half_buffer_len = int(len(tmp_ai_data) / 2)
-            buffer_index = 0
+            half_buffer_len = int(len(ai_data) / 2)
+            halves = ai_data[:half_buffer_len], ai_data[half_buffer_len:]
+            # halves are taken in order, positions count all values transferred by the board since the start
+            half_index = 0
+            self._values_read = 0
+            self._overrun_values = 0
+            self._loop_start_time = time.perf_counter()
 
-            channels_num = self._ao_params.high_channel - self._ao_params.low_channel + 1
-            buffers_num = int(len(self._ao_buffer) / (self._ao_params.sample_rate * channels_num))
+            samples_per_half = self._ai_device_handler.get_samples_per_channel() // 2
+            samples_num = int(self._samples_per_channel * self._ai_params.sample_rate / self._ao_params.sample_rate)
+            # the last half is acquired whole, if the buffer doesn't divide the profile, its tail isn't stored
+            halves_num = -(-samples_num // samples_per_half)
+            buffers_num = -(-halves_num // 2)
+            self._buffer_index, self._buffers_num = 0, buffers_num
 
             if not os.path.exists(RAW_DATA_FOLDER_REL_PATH):
                 os.makedirs(RAW_DATA_FOLDER_REL_PATH)
 
+            if do_save_data:
+                # one dataset for the whole profile, one chunk per half of the buffer
+                ai_channels_num = self._ai_params.high_channel - self._ai_params.low_channel + 1
+                # without NOSCALEDATA flag the board returns volts, otherwise counts are stored as they are.
+                # Counts shrink only the raw dataset: the calibrated dataset stays float64 and so does the AI
+                # buffer of uldaq, so a whole results file gets about 40% smaller (5.28 MB -> 3.12 MB), not 4x.
+                raw_dtype = np.float64 if self._ai_params.is_scaled() else self._ai_device_handler.get_count_dtype()
+                results_path = self._results_file if self._results_file is not None else RAW_DATA_FILE_REL_PATH
+                store = RawDataStore(results_path, samples_num, ai_channels_num,
+                                     samples_per_half, keep_raw=self._keep_raw_data,
+                                     group=self._results_group, filters=self._storage_params.get_filters(),
+                                     raw_dtype=raw_dtype)
+                store.set_attrs(sample_rate=self._ai_params.sample_rate,
+                                low_channel=self._ai_params.low_channel,
+                                high_channel=self._ai_params.high_channel,
+                                range_id=self._ai_params.range_id,
+                                scan_flags=int(self._ai_params.scan_flags),
+                                setup_time=self._setup_metrics['setup_time'],
+                                **self._run_attrs)
+                scaling = None
+                if not self._ai_params.is_scaled():
+                    scaling = self._ai_device_handler.get_scaling()
+                    store.set_scaling(*scaling)
+                    store.set_attrs(resolution=self._ai_device_handler.get_resolution())
+                for stage in self._stages:
+                    stage.start(store)
+                # a half of the buffer can be held back until the board starts to overwrite it
+                half_buffer_time = half_buffer_len / (self._ai_params.sample_rate * ai_channels_num)
+                writer = BlockWriter(half_buffer_len, self._get_block_processor(store, ai_channels_num, scaling),
+                                     timeout=half_buffer_time / 2, dtype=raw_dtype)
+
             while True:
+                iterations += 1
                 try:
-                    # Get AI operation status and index
+                    # Get AI operation status and the number of transferred values
                     _, ai_transfer_status = self._ai_device_handler.status()
-                    ai_index = ai_transfer_status.current_index
+                    ai_count = ai_transfer_status.current_total_count
 
-                    if buffer_index >= buffers_num:
+                    if half_index >= halves_num:
+                        self._buffer_index = buffers_num
+                        self._ai_device_handler.stop()
+                        is_complete = True
+                        break
+                    if self._abort_event.is_set():
+                        logging.warning('WARNING. Acquisition aborted after {} of {} buffers.'.format(half_index // 2,
+                                                                                                     buffers_num))
                         self._ai_device_handler.stop()
-                        # merging all the buffer files into one file raw_data.h5
-                        fpath = RAW_DATA_FILE_REL_PATH
-                        for i in list(range(buffers_num)):
-                            buf_path = os.path.join(RAW_DATA_FOLDER_REL_PATH, RAW_DATA_BUFFER_FILE_FORMAT.format(i))
-                            df = pd.DataFrame(pd.read_hdf(buf_path, key='dataset'))
-                            df.to_hdf(fpath, key='dataset', format='table', append=True, mode='a')
-                        break  
-
-                    if ai_index > half_buffer_len and is_buffer_high_half:
-                        # reading low half 
-                        logging.info('Reading low half. Index = {}. Buffer index = {}'.format(ai_index, buffer_index))
-                        df = pd.DataFrame(tmp_ai_data[:half_buffer_len])
-                        if do_save_data:
-                            fpath = os.path.join(RAW_DATA_FOLDER_REL_PATH, RAW_DATA_BUFFER_FILE_FORMAT.format(buffer_index))
-                            df.to_hdf(fpath, key='dataset', format='table', append=True, mode='a')
-                        is_buffer_high_half = False
-                    elif ai_index < half_buffer_len and not is_buffer_high_half:
-                        # reading high half
-                        logging.info('Reading high half. Index = {}. Buffer index = {}'.format(ai_index, buffer_index))
-                        df = pd.DataFrame(tmp_ai_data[half_buffer_len:])
-                        if do_save_data:
-                            fpath = os.path.join(RAW_DATA_FOLDER_REL_PATH, RAW_DATA_BUFFER_FILE_FORMAT.format(buffer_index))
-                            df.to_hdf(fpath, key='dataset', format='table', append=True, mode='a')
-                        is_buffer_high_half = True
-                        buffer_index += 1
+                        break
+
+                    if ai_count >= self._values_read + half_buffer_len:
+                        logging.info('Reading {} half. Count = {}. Buffer index = {}'.format(
+                            'low' if half_index % 2 == 0 else 'high', ai_count, half_index // 2))
+                        if writer is not None:
+                            writer.put(halves[half_index % 2], half_index)
+                        flip_latencies.add(self._get_flip_latency(ai_transfer_status, half_index + 1))
+                        self._check_overrun(half_buffer_len)
+                        self._values_read += half_buffer_len
+                        half_index += 1
+                        self._buffer_index = half_index // 2
+                    else:
+                        # sleeping until the half being filled now is complete
+                        self._scan_waiter.wait(ai_count, self._values_read + half_buffer_len)
                 except (ValueError, NameError, SyntaxError):
                     break
         except KeyboardInterrupt:
             logging.warning('WARNING. Acquisition aborted.')
             pass
+        finally:
+            self._is_finishing = True
+            if not is_complete:
+                # the heater is switched off before the queued blocks are drained, which can take seconds
+                self._ai_device_handler.stop()
+                self._stop_streaming()
+                self._zero_ao()
+            if writer is not None:
+                # waiting for all queued blocks, also when the run was aborted or failed
+                self._ai_device_handler.stop()
+                try:
+                    writer.close()
+                except RuntimeError as e:
+                    logging.error("ERROR. {}".format(e))
+                self._writer_metrics = writer.get_metrics()
+                logging.info('Data writer: {}'.format(self._writer_metrics))
+            ai_channels_num = self._ai_params.high_channel - self._ai_params.low_channel + 1
+            overrun_samples = self._overrun_values // ai_channels_num
+            self._wait_metrics = dict(wait_mode=type(self._scan_waiter).__name__,
+                                      iterations=iterations,
+                                      wakeups=self._scan_waiter.get_wakeups(),
+                                      mean_flip_latency=flip_latencies.get_mean(),
+                                      max_flip_latency=flip_latencies.get_max(),
+                                      flip_latency=flip_latencies.to_dict(),
+                                      buffer_samples=self._ai_device_handler.get_samples_per_channel(),
+                                      overrun_samples=overrun_samples)
+            logging.info('AI read loop: {}'.format(self._wait_metrics))
+            if store is not None:
+                for stage in self._stages:
+                    stage.finish()
+                self._bytes_written = store.get_bytes_written()
+                self._bytes_on_disk = store.get_bytes_on_disk()
+                # runs with overwritten data are flagged, the data of overrun halves is not valid
+                store.set_attrs(overrun=overrun_samples > 0, overrun_samples=overrun_samples)
+                store.set_attrs(**{METRICS_ATTR: json.dumps(self.get_metrics(), default=float)})
+                store.close()
+            # the loop latency decides the length of an adaptive buffer of the next run
+            self._ai_device_handler.set_latency(max(flip_latencies.get_max(),
+                                                    self._writer_metrics.get('max_write_time', 0.)))
+
+    def _get_block_processor(self, store: RawDataStore, channels_num: int, scaling: Optional[tuple] = None):
+        # runs in the writer thread: storing of raw data, then all processing stages,
+        # stages get whole blocks, the store trims rows after the profile end
+        def process_block(block: np.ndarray, block_index: int):
+            rows = deinterleave(block, channels_num)
+            if self._keep_raw_data:
+                store.write_rows(RAW_DATA_DATASET, rows, block_index)
+            if scaling is not None and self._stages:
+                # stages always get volts, ADC counts are scaled only if they are processed
+                rows = rows * scaling[0] + scaling[1]
+            for stage in self._stages:
+                stage.process_block(rows, block_index)
+        return process_block
+
+    def _check_overrun(self, half_buffer_len: int):
+        """Counts values of the half being taken, which the board overwrote before they were copied."""
+        _, ai_transfer_status = self._ai_device_handler.status()
+        # a value at a position is overwritten when the board reaches the position plus the buffer length
+        overwritten = ai_transfer_status.current_total_count - (self._values_read + 2 * half_buffer_len)
+        overrun_values = min(max(overwritten, 0), half_buffer_len)
+        if overrun_values > 0:
+            self._overrun_values += overrun_values
+            logging.error("ERROR. AI data overrun. {} of {} values of half-buffer {} were overwritten before they "
+                          "were read.".format(overrun_values, half_buffer_len, self._values_read // half_buffer_len))
+
+    def _get_flip_latency(self, ai_transfer_status: ul.TransferStatus, flips_num: int) -> float:
+        """Time (s) passed since the board crossed the half-buffer boundary till the loop noticed it."""
+        samples_per_half_buffer = len(self._ai_device_handler.get_buffer()) / \
+            (2 * (self._ai_params.high_channel - self._ai_params.low_channel + 1))
+        return (ai_transfer_status.current_scan_count - flips_num * samples_per_half_buffer) / \
+            self._ai_params.sample_rate
 
     def __enter__(self):
         return self
@@ -170,10 +488,11 @@ class ExperimentManager:
         if exc_value is not None:
             logging.error("ERROR. Exception {} of type {}. Traceback: {}".format(exc_value, exc_type, exc_tb))
 
+        self._stop_streaming()
         if self._daq_device_handler:
-            if self._ai_device_handler.status() == ul.ScanStatus.RUNNING:
+            if self._ai_device_handler is not None and self._ai_device_handler.status()[0] == ul.ScanStatus.RUNNING:
                 self._ai_device_handler.stop()
-            if self._ao_device_handler.status() == ul.ScanStatus.RUNNING:
+            if self._ao_device_handler is not None and self._ao_device_handler.status()[0] == ul.ScanStatus.RUNNING:
                 self._ao_device_handler.stop()
             # self._daq_device_handler.quit()
         # TODO: maybe add here dumping into h5 file??  # @EK: seems quite reasonable
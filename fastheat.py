@@ -1,13 +1,22 @@
 from experiment_manager import ExperimentManager
+from data_writer import BlockStage
+from ao_data_generators import ModulationGenerator, ScanDataGenerator
+from ao_buffer_cache import AoBufferCache, get_profile_key, get_profile_provenance
 from daq_device import DaqDeviceHandler
-from utils import temperature_to_voltage
+from utils import TemperatureVoltageConverter
 from settings import SettingsParser
 from calibration import Calibration
+from calibration_engine import CalibrationEngine, StreamingCalibration, CALIBRATED_COLUMNS
+from lock_in import LockInStage, LOCK_IN_COLUMNS
+from raw_data_store import RawDataStore
+from constants import CALIBRATED_DATA_DATASET, LOCK_IN_DATASET, RAW_DATA_FILE_REL_PATH
 
 from scipy import interpolate
-from typing import Dict
+from ctypes import Array
+from typing import Dict, List, Optional
 import pandas as pd
 import numpy as np
+import threading
 import logging
 
 
@@ -15,14 +24,20 @@ class FastHeat:
     def __init__(self, daq_device_handler: DaqDeviceHandler,
                  settings_parser: SettingsParser,
                  time_temp_table: dict,
-                 calibration: Calibration):
+                 calibration: Calibration,
+                 ao_buffer_cache: Optional[AoBufferCache] = None,
+                 abort_event: Optional[threading.Event] = None):
 
         self._daq_device_handler = daq_device_handler
         self._settings_parser = settings_parser
 
         self._set_temp_profile_data(time_temp_table)
+        self._time_temp_table = time_temp_table
+        self._ao_buffer_cache = ao_buffer_cache
 
         self._calibration = calibration
+        self._converter = TemperatureVoltageConverter(
+            calibration, mode=self._settings_parser.get_ao_params().temperature_conversion)
 
         self._ai_channels = [0, 1, 2, 3, 4, 5]
 
@@ -34,6 +49,13 @@ class FastHeat:
             raise ValueError(error_str)
 
         self._voltage_profiles = dict()
+        self._ao_buffer: Optional[Array[float]] = None
+        self._modulation = None
+        self._lock_in_data = None
+        self._stages: List[BlockStage] = []
+        self._em: Optional[ExperimentManager] = None
+        # exists before the run starts, so an abort requested right after starting the run is not lost
+        self._abort_event = abort_event if abort_event is not None else threading.Event()
 
     def _set_temp_profile_data(self, time_temp_table):
         if len(time_temp_table['time']) != len(time_temp_table['temperature']):
@@ -46,6 +68,10 @@ class FastHeat:
     def get_ai_data(self) -> pd.DataFrame:
         """Provides explicit access to the already read AI data."""
         return self._ai_data
+
+    def get_lock_in_data(self) -> Optional[pd.DataFrame]:
+        """Provides decimated amplitude and phase of the modulation of the last run, None without modulation."""
+        return self._lock_in_data
     
     def __enter__(self):
         return self
@@ -55,75 +81,163 @@ class FastHeat:
             logging.error("ERROR. Exception {} of type {}. Traceback: {}".format(exc_value, exc_type, exc_tb))
             self._daq_device_handler.quit()  # TODO: check is it needed
 
+    def add_stage(self, stage: BlockStage):
+        """Adds a stage, processing every stored AI block during the run, e.g. a live preview."""
+        self._stages.append(stage)
+
+    def get_modulation_reference(self) -> dict:
+        """Provides the parameters and the initial phase of the modulation applied to channel 0."""
+        return self._modulation.get_reference()
+
     def arm(self) -> Dict[str, np.array]:
-        # arm 0.1 to 0 channel (Uref). 0.1 - value of the offset. TODO: change
-        self._voltage_profiles['ch0'] = self._get_channel0_voltage()
-        # arm voltage profile to ch1
-        self._voltage_profiles['ch1'] = self._get_channel1_voltage()
+        # modulation parameters are taken from the calibration at the moment of arming
+        self._modulation = ModulationGenerator(self._calibration.amplitude, self._calibration.offset,
+                                               self._calibration.frequency,
+                                               self._settings_parser.get_ao_params().sample_rate)
+        if self._is_streamed():
+            # long programs are computed chunk by chunk while being played, so memory doesn't grow with their length
+            self._voltage_profiles['ch0'] = self._get_channel0_voltage
+            self._voltage_profiles['ch1'] = self._get_channel1_voltage
+            self._ao_buffer = None
+            return self._voltage_profiles
+
+        ao_params = self._settings_parser.get_ao_params()
+        key = get_profile_key(self._time_temp_table, self._calibration, ao_params)
+        self._ao_buffer = self._ao_buffer_cache.get(key) if self._ao_buffer_cache is not None else None
+        if self._ao_buffer is None:
+            # arm modulation to 0 channel (Uref) and voltage profile to ch1
+            voltage_profiles = dict(ch0=self._get_channel0_voltage(), ch1=self._get_channel1_voltage())
+            self._ao_buffer = ScanDataGenerator(voltage_profiles, ao_params.low_channel,
+                                                ao_params.high_channel).get_buffer()
+            if self._ao_buffer_cache is not None:
+                self._ao_buffer_cache.put(key, self._ao_buffer,
+                                          get_profile_provenance(self._time_temp_table, self._calibration, ao_params))
+        else:
+            logging.info("Armed AO buffer is taken from the cache.")
+
+        # profiles are views of the interleaved buffer columns, not copies
+        channels_num = ao_params.high_channel - ao_params.low_channel + 1
+        columns = np.ctypeslib.as_array(self._ao_buffer).reshape(-1, channels_num)
+        for ch in [0, 1]:
+            if ao_params.low_channel <= ch <= ao_params.high_channel:
+                self._voltage_profiles['ch' + str(ch)] = columns[:, ch - ao_params.low_channel]
         return self._voltage_profiles  # returns for debug. TODO: remove
 
+    def _is_streamed(self) -> bool:
+        ao_params = self._settings_parser.get_ao_params()
+        return 0 < ao_params.stream_buffer * ao_params.sample_rate < self._samples_per_channel
+
     def is_armed(self) -> bool:
         return not not self._voltage_profiles
 
-    def run(self):
+    def abort(self):
+        """Stops the current run from another thread, the heater is set to 0 V.
+
+        A run started after the abort is aborted at once, see clear_abort.
+        """
+        logging.warning('WARNING. Fast heating abort requested.')
+        self._abort_event.set()
+
+    def clear_abort(self):
+        """Allows the next run after an abort. Must not be called while a run can be aborted."""
+        self._abort_event.clear()
+
+    def is_aborted(self) -> bool:
+        return self._abort_event.is_set()
+
+    def get_progress(self) -> dict:
+        """Provides progress of the current or the last run, see ExperimentManager.get_progress."""
+        if self._em is None:
+            return dict(buffer_index=0, buffers_num=0, data_rate=0., finishing=False)
+        return self._em.get_progress()
+
+    def get_metrics(self) -> dict:
+        """Provides metrics of the last run, see ExperimentManager.get_metrics."""
+        return self._em.get_metrics() if self._em is not None else dict()
+
+    def run(self, em: Optional[ExperimentManager] = None):
+        """Runs the armed profile.
+
+        Args:
+            em: ExperimentManager to reuse, e.g. by a sequence, which also decides where the results are written.
+                By default a new one is created and the results are loaded for get_ai_data and get_lock_in_data.
+        """
+        if em is not None:
+            self._em = em
+            em.set_profiles(self._voltage_profiles, self._samples_per_channel, self._ao_buffer)
+            self._add_stages(em)
+            em.run()
+            return
+
         # voltage data for each used AO channel like {'ch0': [.......], 'ch3': [........]}
-        with ExperimentManager(self._daq_device_handler,
-                               self._voltage_profiles,
-                               self._settings_parser) as em:
+        self._em = ExperimentManager(self._daq_device_handler,
+                                     self._voltage_profiles,
+                                     self._settings_parser,
+                                     self._samples_per_channel,
+                                     self._ao_buffer,
+                                     self._abort_event)
+        with self._em as em:
+            lock_in = self._add_stages(em)
             em.run()
-            self._ai_data = em.get_ai_data(self._ai_channels)  # TODO: check warning
-            
-        self._apply_calibration()
+            ai_sample_rate = self._settings_parser.get_ai_params().sample_rate
+            self._ai_data = em.get_dataset(CALIBRATED_DATA_DATASET, CALIBRATED_COLUMNS, ai_sample_rate)
+            self._lock_in_data = None if lock_in is None else \
+                em.get_dataset(LOCK_IN_DATASET, LOCK_IN_COLUMNS, lock_in.get_sample_rate())
+
+    def _add_stages(self, em: ExperimentManager) -> Optional[LockInStage]:
+        # data is calibrated block by block during the acquisition
+        em.add_stage(StreamingCalibration(self._calibration))
+        for stage in self._stages:
+            em.add_stage(stage)
+        em.add_run_attrs(**self._modulation.get_reference())
+        lock_in = None
+        if self._calibration.amplitude != 0 and self._calibration.frequency > 0:
+            lock_in = LockInStage(self._calibration, self._modulation.get_reference(),
+                                  self._settings_parser.get_ai_params().sample_rate)
+            em.add_stage(lock_in)
+        return lock_in
+
+    def recalibrate(self):
+        """Calibrates the stored raw data of the last run again, e.g. after the calibration was changed.
+
+        Unlike the online calibration, Taux is the mean over the whole run.
+        """
+        raw = RawDataStore.read(RAW_DATA_FILE_REL_PATH, self._ai_channels)
+        if not len(raw):
+            error_str = "Raw data of the last run was not stored, see KeepRawData setting."
+            logging.error(error_str)
+            raise ValueError(error_str)
+        self._apply_calibration(raw)
 
-    def _get_channel0_voltage(self) -> np.array:
-        return np.ones(self._samples_per_channel) / 10.  # apply 0.1 voltage on channel 0
+    def _get_channel0_voltage(self, indices: Optional[np.ndarray] = None) -> np.array:
+        # offset + amplitude * sin, taken from the precomputed table of the modulation
+        if indices is None:
+            return self._modulation.get_profile(self._samples_per_channel)
+        return self._modulation(indices)
 
-    def _get_channel1_voltage(self) -> np.array:
-        # construct voltage profile to ch1
+    def _get_channel1_voltage(self, indices: Optional[np.ndarray] = None) -> np.array:
+        # construct voltage profile to ch1, the whole one or only the given samples of it
         interpolation = interpolate.interp1d(x=self._profile_time, y=self._profile_temp, kind='linear')
-        
-        time_program_points = np.linspace(self._profile_time[0], self._profile_time[-1], self._samples_per_channel)
+
+        if indices is None:
+            time_program_points = np.linspace(self._profile_time[0], self._profile_time[-1],
+                                              self._samples_per_channel)
+        else:
+            time_step = (self._profile_time[-1] - self._profile_time[0]) / (self._samples_per_channel - 1)
+            time_program_points = self._profile_time[0] + indices * time_step
         temp_program_points = interpolation(time_program_points)
 
-        volt_program_points = temperature_to_voltage(temp_program_points, self._calibration)
+        volt_program_points = self._converter.temperature_to_voltage(temp_program_points)
         return volt_program_points
 
-    def _apply_calibration(self):
-        # Taux - mean for the whole buffer
-        Uaux = self._ai_data[3].mean()
-        Taux = 100. * Uaux
-        if Taux < -12.:  # correction for AD595 below -12 C
-            Taux = 2.6843 + 1.2709 * Taux + 0.0042867 * Taux * Taux + 3.4944e-05 * Taux * Taux * Taux
-        self._ai_data['Taux'] = Taux
-        
-        # Utpl or temp - temperature of the calibrated internal thermopile + Taux
-        self._ai_data[4] *= (1000. / 11.)  # scaling to mV with the respect of amplification factor of 11
-        ax = self._ai_data[4] + self._calibration.utpl0
-        self._ai_data['temp'] = self._calibration.ttpl0 * ax + self._calibration.ttpl1 * (ax ** 2)
-        self._ai_data['temp'] += Taux
-
-        # temp-hr ??? add explanation Umod mV
-        
-        self._ai_data[1] *= (1000. / 121.)  # scaling to mV; why 121?? amplifier cascade??
-        ax = self._ai_data[1] + self._calibration.utpl0
-        self._ai_data['temp-hr'] = self._calibration.ttpl0 * ax + self._calibration.ttpl1 * (ax ** 2)
+    def _apply_calibration(self, raw: np.ndarray):
+        # Taux - mean for the whole buffer, the frame is built once from the calibrated columns
+        time_index = pd.Index(np.arange(len(raw)) * (1000. / self._settings_parser.get_ai_params().sample_rate),
+                              name='time')
+        self._ai_data = CalibrationEngine(self._calibration).apply(raw, index=time_index)
 
         # Uref
         # ===================
         # profile = pd.DataFrame(self.voltage_profiles['ch1'])
         # Uref = pd.concat(profile*(int(len(self.ai_data[0])/len(profile))), ignore_index=True) # generating repeated profiles
         # self.ai_data['Uref'] = profile
-        
-        # Thtr
-        self._ai_data[5] *= 1000.  # Uhtr mV
-        Rhtr = self._ai_data[5] * 0.
-        Ih = self._calibration.ihtr0 + self._ai_data[0] * self._calibration.ihtr1
-        Rhtr.loc[Ih!=0] = (self._ai_data[5] - self._ai_data[0] * 1000. + self._calibration.uhtr0) * self._calibration.uhtr1 / Ih
-        # Rhtr.loc[Ih==0] = 0
-        Thtr = self._calibration.thtr0 + \
-               self._calibration.thtr1 * (Rhtr + self._calibration.thtrcorr) + \
-               self._calibration.thtr2 * ((Rhtr + self._calibration.thtrcorr) ** 2)
-        self._ai_data['Thtr'] = Thtr
-        self._ai_data['Uhtr'] = self._ai_data[5]
-        
-        self._ai_data.drop(self._ai_channels, axis=1, inplace=True)
@@ -0,0 +1,118 @@
+from calibration import Calibration
+from data_writer import BlockStage
+from ao_data_generators import ModulationGenerator
+from calibration_engine import aux_temperature, thermopile_temperature, UMOD_CHANNEL, UMOD_SCALE, UAUX_CHANNEL, \
+    UTPL_CHANNEL
+from constants import LOCK_IN_DATASET
+
+from typing import Optional
+from scipy import signal
+import numpy as np
+
+LOCK_IN_COLUMNS = ['temp', 'amplitude', 'phase']
+
+LOCK_IN_FILTER_ORDER = 4
+LOCK_IN_CUTOFF_RATIO = 10.  # default cutoff of the low-pass filter is modulation frequency / 10
+LOCK_IN_OUTPUT_RATIO = 4.  # default output rate is 4 cutoff frequencies
+
+
+class LockInStage(BlockStage):
+    """Demodulates the modulation thermopile signal block by block into decimated amplitude and phase.
+
+    The signal is multiplied by sin and cos references, taken from precomputed tables by absolute AI sample index,
+    and low-pass filtered by a Butterworth filter, whose state is carried from block to block, so the result
+    doesn't depend on block boundaries. The thermopile temperature is filtered the same way, and the amplitude
+    is divided by the amplitude correction polynomial of it. Results are delayed by the group delay of the filter.
+    """
+
+    def __init__(self, calibration: Calibration, reference: dict, sample_rate: int,
+                 cutoff: Optional[float] = None, decimation: Optional[int] = None,
+                 order: int = LOCK_IN_FILTER_ORDER):
+        """Prepares reference tables and the filter.
+
+        Args:
+            calibration: Calibration with thermopile and amplitude correction coefficients.
+            reference: Modulation reference, like provided by ModulationGenerator.get_reference().
+            sample_rate: AI sample rate, Hz.
+            cutoff: Cutoff frequency (Hz) of the low-pass filter, modulation frequency / 10 by default.
+            decimation: Number of AI samples per output point, the output rate is 4 cutoffs by default.
+            order: Order of the low-pass filter.
+
+        Raises:
+            ValueError if there is no modulation or the cutoff is above the Nyquist frequency.
+        """
+        frequency = reference['modulation_frequency']
+        if frequency <= 0:
+            raise ValueError("Cannot demodulate signal without modulation.")
+        self._cutoff = cutoff if cutoff is not None else frequency / LOCK_IN_CUTOFF_RATIO
+        if not 0 < self._cutoff < sample_rate / 2:
+            raise ValueError("Lock-in cutoff {} Hz is out of (0, {}) Hz.".format(self._cutoff, sample_rate / 2))
+        self._decimation = decimation if decimation is not None else \
+            max(int(sample_rate / (LOCK_IN_OUTPUT_RATIO * self._cutoff)), 1)
+
+        self._calibration = calibration
+        self._sample_rate = sample_rate
+        self._sos = signal.butter(order, self._cutoff, fs=sample_rate, output='sos')
+        # phase is counted from the first AI sample, so the delay between AO and AI starts shifts the measured phase
+        self._sin = ModulationGenerator(1., 0., frequency, sample_rate, reference['modulation_phase'])
+        self._cos = ModulationGenerator(1., 0., frequency, sample_rate, reference['modulation_phase'] + np.pi / 2)
+
+        self._store = None
+        self._zi = None
+        self._mixed = None
+        self._uaux_sum = 0.
+        self._samples_num = 0
+
+    def get_sample_rate(self) -> float:
+        """Provides the rate (Hz) of the decimated output."""
+        return self._sample_rate / self._decimation
+
+    def start(self, store):
+        self._store = store
+        self._store.create_dataset(LOCK_IN_DATASET, len(LOCK_IN_COLUMNS), LOCK_IN_COLUMNS, self._decimation)
+        self._zi = None
+        self._mixed = None
+        self._uaux_sum = 0.
+        self._samples_num = 0
+
+    def process_block(self, rows: np.ndarray, block_index: int):
+        start = block_index * len(rows)
+        indices = np.arange(start, start + len(rows))
+
+        # in-phase and quadrature products and the thermopile voltage, filtered together
+        if self._mixed is None or len(self._mixed) != len(rows):
+            self._mixed = np.empty((len(rows), 3))
+        np.multiply(rows[:, UMOD_CHANNEL], UMOD_SCALE, out=self._mixed[:, 2])
+        np.multiply(self._mixed[:, 2], self._sin(indices), out=self._mixed[:, 0])
+        np.multiply(self._mixed[:, 2], self._cos(indices), out=self._mixed[:, 1])
+        self._mixed[:, 2] = rows[:, UTPL_CHANNEL]
+        if self._zi is None:
+            # steady state for the first samples, so the output doesn't start with the filter transient,
+            # products oscillate, so their mean over the first block is taken
+            initial = self._mixed.mean(axis=0)
+            initial[2] = self._mixed[0, 2]
+            self._zi = signal.sosfilt_zi(self._sos)[:, :, np.newaxis] * initial
+        filtered, self._zi = signal.sosfilt(self._sos, self._mixed, axis=0, zi=self._zi)
+
+        self._uaux_sum += float(rows[:, UAUX_CHANNEL].sum())
+        self._samples_num += len(rows)
+        taux = aux_temperature(self._uaux_sum / self._samples_num)
+
+        # output points are the samples with indices divisible by decimation
+        points = filtered[(-start) % self._decimation::self._decimation]
+        out = np.empty((len(points), len(LOCK_IN_COLUMNS)))
+        temp = out[:, 0]
+        temp[:] = thermopile_temperature(points[:, 2], self._calibration, taux)
+        in_phase, quadrature = 2 * points[:, 0], 2 * points[:, 1]
+
+        c = self._calibration
+        correction = ((c.ac3 * temp + c.ac2) * temp + c.ac1) * temp + c.ac0
+        amplitude = out[:, 1]
+        np.hypot(in_phase, quadrature, out=amplitude)
+        np.divide(amplitude, correction, out=amplitude, where=correction != 0)
+        np.arctan2(quadrature, in_phase, out=out[:, 2])
+
+        self._store.write_rows(LOCK_IN_DATASET, out, block_index)
+
+    def finish(self):
+        self._store = None
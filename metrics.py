@@ -0,0 +1,84 @@
+from constants import HISTOGRAM_LOW, HISTOGRAM_HIGH, HISTOGRAM_BINS_PER_DECADE
+
+import numpy as np
+import math
+
+
+class Histogram:
+    """Counts positive values, e.g. latencies in s, in logarithmic bins.
+
+    Bins are preallocated and a value is added in constant time, so the histogram can be updated
+    on every block of the acquisition. Values out of the range are counted in the first or the last bin.
+    """
+
+    def __init__(self, low: float = HISTOGRAM_LOW, high: float = HISTOGRAM_HIGH,
+                 bins_per_decade: int = HISTOGRAM_BINS_PER_DECADE):
+        """Initializes empty bins.
+
+        Args:
+            low: Lower edge of the first bin.
+            high: Upper edge of the last bin.
+            bins_per_decade: Number of bins per factor of 10.
+        """
+        self._log_low = math.log10(low)
+        self._bins_per_decade = bins_per_decade
+        bins_num = int(math.ceil((math.log10(high) - self._log_low) * bins_per_decade))
+        self._edges = 10 ** (self._log_low + np.arange(bins_num + 1) / bins_per_decade)
+        self._counts = np.zeros(bins_num, dtype=np.int64)
+        self._count = 0
+        self._sum = 0.
+        self._max = 0.
+
+    def add(self, value: float):
+        index = int((math.log10(value) - self._log_low) * self._bins_per_decade) if value > 0 else 0
+        self._counts[min(max(index, 0), len(self._counts) - 1)] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    def get_count(self) -> int:
+        return self._count
+
+    def get_mean(self) -> float:
+        return self._sum / self._count if self._count else 0.
+
+    def get_max(self) -> float:
+        return self._max
+
+    def to_dict(self) -> dict:
+        """Provides bin edges, counts and statistics, e.g. to be written as JSON."""
+        return dict(edges=self._edges.tolist(),
+                    counts=self._counts.tolist(),
+                    count=self._count,
+                    mean=self.get_mean(),
+                    max=self._max)
+
+
+def flatten_metrics(metrics: dict, prefix: str = '') -> dict:
+    """Turns nested metrics like {'writer': {'blocks_written': 3}} into {'writer_blocks_written': 3}.
+
+    Lists become arrays, None values are left out, so the result can be sent as a Tango pipe blob.
+    """
+    flat = dict()
+    for name, value in metrics.items():
+        key = prefix + name
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, key + '_'))
+        elif isinstance(value, (list, tuple)):
+            flat[key] = np.asarray(value)
+        elif value is not None:
+            flat[key] = value
+    return flat
+
+
+if __name__ == '__main__':
+    import time
+
+    histogram = Histogram()
+    values = np.random.lognormal(np.log(1e-3), 1., 100000)
+    start = time.perf_counter()
+    for v in values:
+        histogram.add(float(v))
+    print("add: {:.3f} us per value".format(1e6 * (time.perf_counter() - start) / len(values)))
+    print(histogram.get_count(), histogram.get_mean(), histogram.get_max())
+    print(flatten_metrics(dict(writer=dict(write_time=histogram.to_dict())))['writer_write_time_counts'])
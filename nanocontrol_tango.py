@@ -1,12 +1,20 @@
 from tango.server import Device, attribute, pipe, command, AttrWriteType
 from constants import (CALIBRATION_PATH, DEFAULT_CALIBRATION_PATH, LOGS_FOLDER_REL_PATH, RAW_DATA_FOLDER_REL_PATH,
-                       NANOCONTROL_LOG_FILE_REL_PATH, SETTINGS_PATH)
+                       NANOCONTROL_LOG_FILE_REL_PATH, SETTINGS_PATH, PREVIEW_MAX_POINTS, PREVIEW_POINTS_PER_BLOCK,
+                       FH_IDLE_STATE, FH_ARMED_STATE, FH_RUNNING_STATE, FH_FINISHING_STATE, FH_DONE_STATE,
+                       FH_FAULT_STATE)
 from calibration import Calibration
 from fastheat import FastHeat
+from metrics import flatten_metrics
+from sequencer import Sequencer, SequenceStep
+from preview import PreviewStage
+from ao_buffer_cache import AoBufferCache, AoBufferStore
 from settings import SettingsParser
 from daq_device import DaqDeviceHandler
 
 import uldaq as ul
+import tango
+import threading
 import logging
 import os
 import json
@@ -14,6 +22,7 @@ import json
 
 class NanoControl(Device):
     _fh: FastHeat
+    _fh_worker: threading.Thread
 
     def init_device(self):
         Device.init_device(self)
@@ -28,17 +37,35 @@ class NanoControl(Device):
         logging.basicConfig(filename=NANOCONTROL_LOG_FILE_REL_PATH, encoding='utf-8', level=logging.DEBUG,
                             filemode="w", format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')  # TODO: remove from class
 
+        self._fh = None
+        self._sequencer = None
+        self._fh_worker = None
+
         self._calibration = Calibration()
         self.apply_default_calibration()
         self._time_temp_table = dict(time=[], temperature=[])
 
+        # kept across commands and, on disk, across restarts, so re-arming an identical protocol takes no time
+        self._ao_buffer_cache = AoBufferCache(store=AoBufferStore())
+        self._set_fh_state(FH_IDLE_STATE)
+
         self._settings_parser = SettingsParser(SETTINGS_PATH)
         daq_params = self._settings_parser.get_daq_params()
         self._daq_device_handler = DaqDeviceHandler(daq_params)
+
+        ai_params = self._settings_parser.get_ai_params()
+        self._preview = PreviewStage(ai_params.high_channel - ai_params.low_channel + 1, ai_params.sample_rate)
+        self._preview.add_listener(self._push_preview)
+        self._preview_channel = 0
+        for name in ['preview_block_time', 'preview_block_min', 'preview_block_max']:
+            self.set_change_event(name, True, False)
         logging.info('TANGO: Initial setup done.')
 
     @command
     def set_connection(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Connection cannot be changed during the run.")
+            return
         try:
             self._daq_device_handler.try_connect()
             logging.info('TANGO: Successfully connected.')
@@ -52,11 +79,17 @@ class NanoControl(Device):
 
     @command
     def reset_connection(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Connection cannot be reset during the run.")
+            return
         self._daq_device_handler.reset()
         logging.info('TANGO: Connection has been reset.')
 
     @command
     def disconnect(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. DAQ device cannot be disconnected during the run.")
+            return
         self._daq_device_handler.disconnect()
         logging.info('TANGO: Successfully disconnected.')
         # self._daq_device_handler.release()
@@ -86,12 +119,18 @@ class NanoControl(Device):
 
     @command(dtype_in=str)
     def load_calibration(self, str_calib):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Calibration cannot be loaded during the run.")
+            return
         with open(CALIBRATION_PATH, 'w') as f:
             json.dump(json.loads(str_calib), f, separators=(',', ': '), indent=4)
             logging.info('TANGO: Calibration file {} was updated from external file.'.format(CALIBRATION_PATH))
 
     @command
     def apply_default_calibration(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Calibration cannot be applied during the run.")
+            return
         try:
             self._calibration.read(DEFAULT_CALIBRATION_PATH)
             logging.info('TANGO: Calibration was applied from {}'.format(DEFAULT_CALIBRATION_PATH))
@@ -100,6 +139,9 @@ class NanoControl(Device):
 
     @command
     def apply_calibration(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Calibration cannot be applied during the run.")
+            return
         try:
             self._calibration.read(CALIBRATION_PATH)
             logging.info('TANGO: Calibration was applied from {}'.format(CALIBRATION_PATH))
@@ -116,30 +158,234 @@ class NanoControl(Device):
 
     @command(dtype_in=[float])
     def set_fh_time_profile(self, time_table):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Fast heating profile cannot be changed during the run.")
+            return
         self._time_temp_table['time'] = time_table
         logging.info("TANGO: Fast heating time profile was set to: [{}]".format('   '.join(map(str, time_table))))
 
     @command(dtype_in=[float])
     def set_fh_temp_profile(self, temp_table):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Fast heating profile cannot be changed during the run.")
+            return
         self._time_temp_table['temperature'] = temp_table
         logging.info("TANGO: Fast heating temperature profile was set to: [{}]".format('   '.join(map(str, temp_table))))
 
     @command
     def arm_fast_heat(self):
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Fast heating cannot be armed during the run.")
+            return
         self._fh = FastHeat(self._daq_device_handler, self._settings_parser,
-                            self._time_temp_table, self._calibration)
+                            self._time_temp_table, self._calibration, self._ao_buffer_cache)
+        self._fh.add_stage(self._preview)
         self._fh.arm()
+        self._sequencer = None
+        self._set_fh_state(FH_ARMED_STATE)
         logging.info("TANGO: Fast heating armed.")
 
+    @command
+    def clear_ao_buffer_cache(self):
+        self._ao_buffer_cache.clear()
+        logging.info("TANGO: AO buffer cache was cleared.")
+
     @command
     def run_fast_heat(self):
-        if self._fh.is_armed():
-            logging.info("TANGO: Fast heating started.")
-            self._fh.run()
-            logging.info("TANGO: Fast heating finished.")
+        """Starts the armed fast heating in a background worker and returns immediately."""
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Fast heating is already running.")
+        elif self._fh is not None and self._fh.is_armed():
+            # an abort of the previous run is cleared before the worker starts, never by the worker
+            self._fh.clear_abort()
+            self._set_fh_state(FH_RUNNING_STATE)
+            self._fh_worker = threading.Thread(target=self._run_fast_heat_worker, name="FastHeat", daemon=True)
+            self._fh_worker.start()
         else:
             logging.warning("TANGO: WARNING. Fast heating cannot be started, since it should be armed first.")
 
+    @command(dtype_in=str)
+    def run_sequence(self, str_sequence):
+        """Runs a sequence of profiles back-to-back in a background worker and returns immediately.
+
+        Args:
+            str_sequence: JSON list of steps like {"time": [...], "temperature": [...], "repeats": 1, "delay": 0.}.
+        """
+        if self._is_fh_running():
+            logging.warning("TANGO: WARNING. Sequence cannot be started during the run.")
+            return
+        try:
+            steps = [SequenceStep.from_dict(step) for step in json.loads(str_sequence)]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error("TANGO: ERROR. Sequence cannot be parsed: {}".format(e))
+            return
+        self._sequencer = Sequencer(self._daq_device_handler, self._settings_parser, self._calibration,
+                                    self._ao_buffer_cache, [self._preview])
+        self._set_fh_state(FH_RUNNING_STATE)
+        self._fh_worker = threading.Thread(target=self._run_sequence_worker, args=(steps,), name="Sequence",
+                                           daemon=True)
+        self._fh_worker.start()
+
+    @command
+    def abort(self):
+        """Stops the running fast heating within a half of the AI buffer and sets the heater to 0 V."""
+        if self._is_fh_running():
+            if self._sequencer is not None:
+                self._sequencer.abort()
+            else:
+                self._fh.abort()
+            logging.warning("TANGO: WARNING. Fast heating abort requested.")
+        else:
+            logging.info("TANGO: Nothing to abort, fast heating is not running.")
+
+    @attribute(dtype=str, label="Fast heating state", doc="IDLE, ARMED, RUNNING, FINISHING, DONE or FAULT")
+    def fh_state(self):
+        if self._fh_state == FH_RUNNING_STATE and self._get_fh_progress()['finishing']:
+            return FH_FINISHING_STATE
+        return self._fh_state
+
+    @attribute(dtype=float, label="Fast heating progress", unit="%", min_value=0, max_value=100,
+               doc="Acquired AI buffers of the current or the last run")
+    def fh_progress(self):
+        progress = self._get_fh_progress()
+        return 100. * progress['buffer_index'] / progress['buffers_num'] if progress['buffers_num'] else 0.
+
+    @attribute(dtype=float, label="Data rate", unit="S/s", doc="AI values read per second during the run")
+    def fh_data_rate(self):
+        return self._get_fh_progress()['data_rate']
+
+    @attribute(dtype=float, label="Setup time", unit="ms", doc="Time from the start of the last run till AI started")
+    def fh_setup_time(self):
+        return 1000. * self._get_fh_metrics().get('setup', dict()).get('setup_time', 0.)
+
+    @attribute(dtype=float, label="Maximal flip latency", unit="ms",
+               doc="Longest time between an AI half-buffer flip and its read in the last run")
+    def fh_max_flip_latency(self):
+        return 1000. * self._get_fh_metrics().get('read_loop', dict()).get('max_flip_latency', 0.)
+
+    @attribute(dtype=int, label="Overrun samples", doc="AI samples per channel overwritten before read in the last run")
+    def fh_overrun_samples(self):
+        return self._get_fh_metrics().get('read_loop', dict()).get('overrun_samples', 0)
+
+    @pipe(label="Run metrics")
+    def fh_metrics(self):
+        """Setup times, scan rates, read loop, writer and streamer statistics and histograms of the last run,
+        and hits and memory usage of the AO buffer cache."""
+        metrics = dict(self._get_fh_metrics(), ao_buffer_cache=self._ao_buffer_cache.get_metrics())
+        return 'Metrics', flatten_metrics(metrics)
+
+    @attribute(dtype=float, label="Sequence progress", unit="%", min_value=0, max_value=100,
+               doc="Finished runs of the current or the last sequence")
+    def sequence_progress(self):
+        if self._sequencer is None:
+            return 0.
+        progress = self._sequencer.get_progress()
+        return 100. * progress['run_index'] / progress['runs_num'] if progress['runs_num'] else 0.
+
+    def _run_fast_heat_worker(self):
+        with tango.EnsureOmniThread():
+            try:
+                logging.info("TANGO: Fast heating started.")
+                self._fh.run()
+                if self._fh.is_aborted():
+                    logging.warning("TANGO: WARNING. Fast heating aborted.")
+                else:
+                    logging.info("TANGO: Fast heating finished.")
+                self._set_fh_state(FH_DONE_STATE)
+            except Exception as e:
+                logging.error("TANGO: ERROR. Fast heating failed: {}".format(e))
+                self._set_fh_state(FH_FAULT_STATE)
+
+    def _run_sequence_worker(self, steps):
+        with tango.EnsureOmniThread():
+            try:
+                logging.info("TANGO: Sequence of {} steps started.".format(len(steps)))
+                path = self._sequencer.run(steps)
+                if self._sequencer.is_aborted():
+                    logging.warning("TANGO: WARNING. Sequence aborted, results are in {}.".format(path))
+                else:
+                    logging.info("TANGO: Sequence finished, results are in {}.".format(path))
+                self._set_fh_state(FH_DONE_STATE)
+            except Exception as e:
+                logging.error("TANGO: ERROR. Sequence failed: {}".format(e))
+                self._set_fh_state(FH_FAULT_STATE)
+
+    def _get_fh_progress(self) -> dict:
+        if self._sequencer is not None:
+            return self._sequencer.get_progress()
+        if self._fh is not None:
+            return self._fh.get_progress()
+        return dict(buffer_index=0, buffers_num=0, data_rate=0., finishing=False)
+
+    def _get_fh_metrics(self) -> dict:
+        if self._sequencer is not None:
+            return self._sequencer.get_metrics()
+        if self._fh is not None:
+            return self._fh.get_metrics()
+        return dict()
+
+    def _is_fh_running(self) -> bool:
+        return self._fh_worker is not None and self._fh_worker.is_alive()
+
+    def _set_fh_state(self, state: str):
+        self._fh_state = state
+        if state == FH_RUNNING_STATE:
+            self.set_state(tango.DevState.RUNNING)
+        elif state == FH_FAULT_STATE:
+            self.set_state(tango.DevState.FAULT)
+        else:
+            self.set_state(tango.DevState.ON)
+
+
+    # ===================================
+    # Live preview
+
+    @attribute(dtype=int, access=AttrWriteType.READ_WRITE, label="Preview AI channel",
+               doc="Position of the previewed channel among the acquired AI channels")
+    def preview_channel(self):
+        return self._preview_channel
+
+    @preview_channel.write
+    def preview_channel(self, channel):
+        if not 0 <= channel < self._preview.get_channels_num():
+            raise ValueError("AI channel {} is not acquired.".format(channel))
+        self._preview_channel = channel
+
+    # the whole history is read by clients on connect, then they follow the pushed blocks
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_MAX_POINTS, label="Preview time", unit="ms",
+               doc="Envelope history of the previewed channel, not pushed, see preview_block_time")
+    def preview_time(self):
+        return self._preview.get_preview(self._preview_channel)[0]
+
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_MAX_POINTS, label="Preview minimum", unit="V")
+    def preview_min(self):
+        return self._preview.get_preview(self._preview_channel)[1]
+
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_MAX_POINTS, label="Preview maximum", unit="V")
+    def preview_max(self):
+        return self._preview.get_preview(self._preview_channel)[2]
+
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_POINTS_PER_BLOCK, label="Preview block time", unit="ms",
+               doc="Envelope of the newest block of the previewed channel, pushed as change events")
+    def preview_block_time(self):
+        return self._preview.get_last_block(self._preview_channel)[0]
+
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_POINTS_PER_BLOCK, label="Preview block minimum", unit="V")
+    def preview_block_min(self):
+        return self._preview.get_last_block(self._preview_channel)[1]
+
+    @attribute(dtype=(float,), max_dim_x=PREVIEW_POINTS_PER_BLOCK, label="Preview block maximum", unit="V")
+    def preview_block_max(self):
+        return self._preview.get_last_block(self._preview_channel)[2]
+
+    def _push_preview(self, preview: PreviewStage):
+        # called by the data writer thread after every block, only the new points are sent
+        times, mins, maxs = preview.get_last_block(self._preview_channel)
+        with tango.EnsureOmniThread():
+            self.push_change_event('preview_block_time', times)
+            self.push_change_event('preview_block_min', mins)
+            self.push_change_event('preview_block_max', maxs)
+
 
 if __name__ == '__main__':
     NanoControl.run_server()
@@ -0,0 +1,105 @@
+from data_writer import BlockStage
+from constants import PREVIEW_POINTS_PER_BLOCK, PREVIEW_HISTORY
+
+from typing import Callable, List, Tuple
+import threading
+import logging
+import numpy as np
+
+
+class PreviewStage(BlockStage):
+    """Keeps a min/max envelope of the most recent AI data for live plotting.
+
+    Every block is reduced to a fixed number of min/max points per channel, whatever the sample rate is,
+    and stored in a ring buffer holding the last seconds of the run. Listeners are called after each block,
+    e.g. to push the envelope of the new block to clients, see get_last_block.
+    """
+
+    def __init__(self, channels_num: int, sample_rate: int, points_per_block: int = PREVIEW_POINTS_PER_BLOCK,
+                 history: float = PREVIEW_HISTORY):
+        """Initializes the preview.
+
+        Args:
+            channels_num: Number of acquired AI channels.
+            sample_rate: AI sample rate, Hz.
+            points_per_block: Number of min/max points per channel a block is reduced to.
+            history: Time (s) the ring buffer keeps.
+        """
+        self._channels_num = channels_num
+        self._sample_rate = sample_rate
+        self._points_per_block = points_per_block
+        self._history = history
+        self._listeners: List[Callable[['PreviewStage'], None]] = []
+        self._lock = threading.Lock()
+        self._allocate(0)
+
+    def add_listener(self, listener: Callable[['PreviewStage'], None]):
+        """Adds a function, called in the writer thread with the stage after every processed block."""
+        self._listeners.append(listener)
+
+    def get_channels_num(self) -> int:
+        return self._channels_num
+
+    def get_preview(self, channel: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns times (ms), minimums and maximums of the channel envelope, from the oldest to the newest point.
+
+        Args:
+            channel: Position of the channel among the acquired ones.
+        """
+        with self._lock:
+            if self._count <= len(self._times):
+                points = slice(0, self._count)
+                return self._times[points].copy(), self._mins[points, channel].copy(), \
+                    self._maxs[points, channel].copy()
+            order = np.roll(np.arange(len(self._times)), -(self._count % len(self._times)))
+            return self._times[order], self._mins[order, channel], self._maxs[order, channel]
+
+    def get_last_block(self, channel: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns times (ms), minimums and maximums of the channel envelope of the newest block only.
+
+        Args:
+            channel: Position of the channel among the acquired ones.
+        """
+        with self._lock:
+            if not self._count:
+                return np.zeros(0), np.zeros(0), np.zeros(0)
+            positions = (self._count - self._last_points_num + np.arange(self._last_points_num)) % len(self._times)
+            return self._times[positions], self._mins[positions, channel], self._maxs[positions, channel]
+
+    def start(self, store):
+        with self._lock:
+            self._allocate(0)
+
+    def process_block(self, rows: np.ndarray, block_index: int):
+        points_num = min(self._points_per_block, len(rows))
+        if not len(self._times):
+            # the block length is known only now, the ring keeps the blocks of the whole history
+            blocks_num = max(int(np.ceil(self._history * self._sample_rate / len(rows))), 1)
+            with self._lock:
+                self._allocate(blocks_num * points_num)
+
+        starts = (np.arange(points_num) * len(rows)) // points_num
+        times = (block_index * len(rows) + starts) * (1000. / self._sample_rate)
+        mins = np.minimum.reduceat(rows, starts, axis=0)
+        maxs = np.maximum.reduceat(rows, starts, axis=0)
+
+        with self._lock:
+            positions = (self._count + np.arange(points_num)) % len(self._times)
+            self._times[positions] = times
+            self._mins[positions] = mins
+            self._maxs[positions] = maxs
+            self._count += points_num
+            self._last_points_num = points_num
+
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:  # preview must never stop the acquisition
+                logging.error("PREVIEW: ERROR. Preview listener failed: {}".format(e))
+
+    def _allocate(self, points_num: int):
+        self._times = np.zeros(points_num)
+        self._mins = np.zeros((points_num, self._channels_num))
+        self._maxs = np.zeros((points_num, self._channels_num))
+        self._count = 0
+        self._last_points_num = 0
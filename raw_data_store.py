@@ -0,0 +1,164 @@
+from typing import List, Optional, Union
+import logging
+
+import numpy as np
+import tables
+
+from constants import RAW_DATA_DATASET, NO_COMPRESSION, DEFAULT_COMPRESSION_LEVEL, NO_SHUFFLE, BYTE_SHUFFLE, \
+    BIT_SHUFFLE
+
+
+class StorageParams:
+    def __init__(self):
+        self.compression = NO_COMPRESSION
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        self.shuffle = NO_SHUFFLE
+        self.keep_raw_data = True  # False - only results of processing stages are stored
+
+    def get_filters(self) -> Optional[tables.Filters]:
+        """Provides PyTables filters of stored datasets, None without compression."""
+        if self.compression == NO_COMPRESSION:
+            return None
+        return tables.Filters(complevel=self.compression_level, complib=self.compression,
+                              shuffle=self.shuffle == BYTE_SHUFFLE, bitshuffle=self.shuffle == BIT_SHUFFLE)
+
+    def __str__(self):
+        return str(vars(self))
+
+
+def get_available_compressions() -> List[str]:
+    """Provides compression libraries PyTables was built with, like 'zlib' or 'blosc:lz4'."""
+    return [complib for complib in tables.filters.all_complibs
+            if tables.which_lib_version(complib.split(':')[0]) is not None]
+
+
+class RawDataStore:
+    """Keeps acquired AI samples in one preallocated, chunked HDF5 array of shape (samples, channels).
+
+    Each written block is a deinterleaved half of the AI buffer and lands directly in its place,
+    so no merging of intermediate files is needed after the acquisition. Processing stages can add
+    their own datasets of the same length and chunking, e.g. calibrated data, or decimated ones,
+    written block by block too.
+    """
+
+    def __init__(self, path: Union[str, tables.File], samples_num: int, channels_num: int, chunk_samples: int,
+                 keep_raw: bool = True, group: Optional[str] = None, filters: Optional[tables.Filters] = None,
+                 raw_dtype=np.float64):
+        """Creates the HDF5 file, overwriting the previous one.
+
+        Args:
+            path: A string path to HDF5 file or an already open tables.File, which is left open by close().
+            samples_num: Expected number of samples per channel for the whole run.
+            channels_num: Number of acquired channels.
+            chunk_samples: Number of samples per channel in one written block, used as a chunk size.
+            keep_raw: If False, raw samples are not expected to be written, only results of processing stages.
+                The raw dataset still keeps run attributes, its unwritten chunks take no space.
+            group: Name of the group for all datasets, e.g. one per run of a sequence, the root by default.
+            filters: PyTables filters of all datasets, e.g. compression, see StorageParams. No filters by default.
+            raw_dtype: Type of raw samples, volts by default or integer ADC counts, see set_scaling.
+                Only the raw dataset is affected, datasets of processing stages keep their own types.
+        """
+        self._samples_num = samples_num
+        self._chunk_samples = chunk_samples
+        self._keep_raw = keep_raw
+        self._filters = filters
+        self._is_file_owned = not isinstance(path, tables.File)
+        self._file = tables.open_file(path, mode='w') if self._is_file_owned else path
+        self._group = self._file.root if group is None else \
+            self._file.create_group(self._file.root, group, createparents=True)
+        self._datasets = dict()
+        self._bytes_written = 0
+        self._decimations = dict()
+        self._samples_written = dict()
+        self.create_dataset(RAW_DATA_DATASET, channels_num, dtype=raw_dtype)
+
+    def create_dataset(self, name: str, columns_num: int, columns: Optional[List[str]] = None, decimation: int = 1,
+                       dtype=np.float64):
+        """Adds a (samples, columns) dataset with the same length and chunking as the raw data.
+
+        A decimated dataset keeps every decimation-th sample of the run, its chunks and length are reduced
+        accordingly. Its rows correspond to raw samples with indices divisible by decimation.
+        """
+        samples_num = -(-self._samples_num // decimation)
+        chunk_samples = max(self._chunk_samples // decimation, 1)
+        dataset = self._file.create_carray(self._group, name, atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                                           shape=(samples_num, columns_num),
+                                           chunkshape=(min(chunk_samples, max(samples_num, 1)), columns_num),
+                                           filters=self._filters)
+        if columns is not None:
+            dataset.attrs.columns = columns
+        dataset.attrs.decimation = decimation
+        self._datasets[name] = dataset
+        self._decimations[name] = decimation
+        self._samples_written[name] = 0
+
+    def write_rows(self, name: str, rows: np.ndarray, block_index: int):
+        """Writes (samples, columns) rows of the block into its place of the dataset."""
+        dataset = self._datasets[name]
+        # the first sample of the block with index divisible by decimation
+        start = -(-block_index * self._chunk_samples // self._decimations[name])
+        rows = rows[:max(len(dataset) - start, 0)]
+        dataset[start:start + len(rows)] = rows
+        self._samples_written[name] = max(self._samples_written[name], start + len(rows))
+        self._bytes_written += rows.nbytes
+
+    def get_bytes_written(self) -> int:
+        """Provides the size of all rows written so far, before compression."""
+        return self._bytes_written
+
+    def get_bytes_on_disk(self) -> int:
+        """Flushes the file and provides the size of all datasets on disk, after compression."""
+        self._file.flush()
+        return sum(dataset.size_on_disk for dataset in self._datasets.values())
+
+    def set_attrs(self, **attrs):
+        """Saves run parameters as attributes of the raw dataset."""
+        for name, value in attrs.items():
+            self._datasets[RAW_DATA_DATASET].attrs[name] = value
+
+    def set_scaling(self, scale: float, offset: float):
+        """Marks raw samples as ADC counts, read() converts them to volts = counts * scale + offset."""
+        self.set_attrs(scale=scale, offset=offset)
+
+    def close(self):
+        for name, dataset in self._datasets.items():
+            if name == RAW_DATA_DATASET and not self._keep_raw:
+                dataset.attrs.samples_written = 0
+                continue
+            if self._samples_written[name] < len(dataset):
+                logging.warning("RAW DATA: WARNING. Only {} of {} samples were written to '{}'.".format(
+                    self._samples_written[name], len(dataset), name))
+            dataset.attrs.samples_written = self._samples_written[name]
+        if self._is_file_owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    @staticmethod
+    def read(path: str, channels: Optional[List[int]] = None, name: str = RAW_DATA_DATASET,
+             group: Optional[str] = None, scaled: bool = True) -> np.ndarray:
+        """Reads the stored samples as a (samples, channels) array.
+
+        ADC counts are converted to volts only for the read channels, see set_scaling.
+
+        Args:
+            path: A string path to HDF5 file.
+            channels: Positions of channels to read, all by default. Other channels are not loaded into memory.
+            name: Name of the dataset, raw data by default.
+            group: Name of the group with the dataset, the root by default.
+            scaled: If False, ADC counts are returned as they are stored.
+        """
+        with tables.open_file(path, mode='r') as f:
+            dataset = f.get_node(f.root if group is None else '/' + group, name)
+            samples_written = dataset.attrs.samples_written if 'samples_written' in dataset.attrs else len(dataset)
+            if channels is None:
+                data = dataset[:samples_written]
+            elif list(channels) == list(range(channels[0], channels[0] + len(channels))):
+                data = dataset[:samples_written, channels[0]:channels[0] + len(channels)]
+            else:
+                data = np.empty((samples_written, len(channels)), dtype=dataset.dtype)
+                for i, channel in enumerate(channels):
+                    data[:, i] = dataset[:samples_written, channel]
+            if scaled and 'scale' in dataset.attrs:
+                data = data * dataset.attrs.scale + dataset.attrs.offset
+            return data
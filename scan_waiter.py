@@ -0,0 +1,119 @@
+import threading
+import logging
+import time
+
+import uldaq as ul
+
+from daq_device import DaqDeviceHandler
+from constants import EVENT_WAIT_MODE, SLEEP_WAIT_MODE, POLL_WAIT_MODE
+
+SLEEP_MARGIN = 0.0005  # s, wake up a bit before the expected buffer flip
+OVERSLEEP_SMOOTHING = 0.2  # weight of the last measurement in the oversleep estimate
+EVENT_WAIT_MARGIN = 0.005  # s, how long an event can be late before the read loop checks the status itself
+
+
+class PollWaiter:
+    """Doesn't wait at all, the read loop busy-polls the scan status."""
+
+    def __init__(self, sample_rate: int, channels_num: int):
+        self._sample_rate = sample_rate
+        self._channels_num = channels_num
+        self._wakeups = 0
+
+    def start(self):
+        self._wakeups = 0
+
+    def wait(self, ai_count: int, target_count: int):
+        """Waits until the number of values transferred by the board is expected to reach target_count.
+
+        Args:
+            ai_count: Number of values transferred since the start of the scan.
+            target_count: Number of values, marking the end of the half of the buffer being filled.
+        """
+        self._wakeups += 1
+
+    def stop(self):
+        pass
+
+    def get_wakeups(self) -> int:
+        return self._wakeups
+
+
+class SleepWaiter(PollWaiter):
+    """Sleeps for the time the board needs to reach the next half-buffer boundary.
+
+    The average oversleep of the OS is measured on the fly and subtracted from the next sleeps.
+    """
+
+    def __init__(self, sample_rate: int, channels_num: int):
+        super().__init__(sample_rate, channels_num)
+        self._oversleep = 0.
+
+    def wait(self, ai_count: int, target_count: int):
+        self._wakeups += 1
+        remaining_time = (target_count - max(ai_count, 0)) / (self._sample_rate * self._channels_num)
+        sleep_time = remaining_time - self._oversleep - SLEEP_MARGIN
+        if sleep_time <= 0:
+            time.sleep(0)  # just yielding, the flip is close
+            return
+        start = time.perf_counter()
+        time.sleep(sleep_time)
+        oversleep = time.perf_counter() - start - sleep_time
+        self._oversleep += OVERSLEEP_SMOOTHING * (oversleep - self._oversleep)
+
+
+class EventWaiter(PollWaiter):
+    """Sleeps until uldaq reports that the next half of the buffer is available.
+
+    The wait never lasts much longer than the board needs to reach the target index: an event can come
+    a scan before the read loop sees the flip, and waiting for the next one would cost a whole half-buffer.
+    Events must be enabled before the scan is started and disabled after it is stopped.
+    """
+
+    _event_types = ul.DaqEventType.ON_DATA_AVAILABLE | ul.DaqEventType.ON_END_OF_INPUT_SCAN | \
+        ul.DaqEventType.ON_INPUT_SCAN_ERROR
+
+    def __init__(self, daq_device_handler: DaqDeviceHandler, sample_rate: int, channels_num: int,
+                 samples_per_event: int):
+        super().__init__(sample_rate, channels_num)
+        self._daq_device_handler = daq_device_handler
+        self._samples_per_event = samples_per_event
+        self._event = threading.Event()
+        self._timeout = 2 * samples_per_event / sample_rate  # guard against a lost event
+
+    def start(self):
+        super().start()
+        self._event.clear()
+        self._daq_device_handler.enable_event(self._event_types, self._samples_per_event,
+                                              self._on_event, None)
+
+    def wait(self, ai_count: int, target_count: int):
+        self._wakeups += 1
+        remaining_time = (target_count - max(ai_count, 0)) / (self._sample_rate * self._channels_num)
+        if self._event.wait(min(max(remaining_time, 0.) + EVENT_WAIT_MARGIN, self._timeout)):
+            self._event.clear()
+
+    def stop(self):
+        self._daq_device_handler.disable_event(self._event_types)
+        self._event.set()
+
+    def _on_event(self, event_callback_args: ul.EventCallbackArgs):
+        if event_callback_args.event_type == ul.DaqEventType.ON_INPUT_SCAN_ERROR:
+            logging.error("ERROR. AI scan error reported by the device, code {}.".format(
+                event_callback_args.event_data))
+        self._event.set()
+
+
+def create_scan_waiter(wait_mode: str, daq_device_handler: DaqDeviceHandler, sample_rate: int,
+                       channels_num: int, samples_per_half_buffer: int) -> PollWaiter:
+    """Creates the waiting strategy for the AI read loop, falls back to sleeping if events aren't supported."""
+    if wait_mode == EVENT_WAIT_MODE:
+        if ul.DaqEventType.ON_DATA_AVAILABLE in daq_device_handler.get_event_types():
+            return EventWaiter(daq_device_handler, sample_rate, channels_num, samples_per_half_buffer)
+        logging.warning("WARNING. DAQ device doesn't support data events, AI loop will sleep instead.")
+        return SleepWaiter(sample_rate, channels_num)
+    if wait_mode == SLEEP_WAIT_MODE:
+        return SleepWaiter(sample_rate, channels_num)
+    if wait_mode == POLL_WAIT_MODE:
+        return PollWaiter(sample_rate, channels_num)
+    raise ValueError("'{}' is not a valid wait mode.".format(wait_mode))
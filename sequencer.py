@@ -0,0 +1,156 @@
+from experiment_manager import ExperimentManager
+from fastheat import FastHeat
+from data_writer import BlockStage
+from ao_buffer_cache import AoBufferCache
+from daq_device import DaqDeviceHandler
+from settings import SettingsParser
+from calibration import Calibration
+from constants import SEQUENCE_FOLDER_REL_PATH, SEQUENCE_FILE_FORMAT, SEQUENCE_RUN_GROUP
+
+from typing import List, Optional
+import numpy as np
+import threading
+import logging
+import tables
+import time
+import os
+
+
+class SequenceStep:
+    """One profile of a sequence, repeated several times with a delay between runs."""
+
+    def __init__(self, time_temp_table: dict, repeats: int = 1, delay: float = 0.):
+        """Initializes the step.
+
+        Args:
+            time_temp_table: Temperature profile like {'time': [...], 'temperature': [...]}.
+            repeats: Number of runs of the profile.
+            delay: Time (s) to wait after each run.
+
+        Raises:
+            ValueError if repeats or delay is negative.
+        """
+        if repeats < 0 or delay < 0:
+            raise ValueError("Sequence step cannot have {} repeats and {} s delay.".format(repeats, delay))
+        self.time_temp_table = time_temp_table
+        self.repeats = repeats
+        self.delay = delay
+
+    @staticmethod
+    def from_dict(step: dict) -> 'SequenceStep':
+        """Creates the step from a dictionary like {'time': [...], 'temperature': [...], 'repeats': 1, 'delay': 0.}."""
+        return SequenceStep(dict(time=step['time'], temperature=step['temperature']),
+                            int(step.get('repeats', 1)), float(step.get('delay', 0.)))
+
+    def __str__(self):
+        return str(vars(self))
+
+
+class Sequencer:
+    """Runs fast heating profiles back-to-back with minimal dead time between them.
+
+    All profiles are armed before the first run. One ExperimentManager makes all the runs, and all runs
+    are written into one open results file, each run into its own group with the step, the repeat
+    and the profile as attributes.
+    """
+
+    def __init__(self, daq_device_handler: DaqDeviceHandler, settings_parser: SettingsParser,
+                 calibration: Calibration, ao_buffer_cache: Optional[AoBufferCache] = None,
+                 stages: Optional[List[BlockStage]] = None):
+        """Initializes the sequencer.
+
+        Args:
+            daq_device_handler: Connected DaqDeviceHandler.
+            settings_parser: SettingsParser with AI and AO parameters.
+            calibration: Calibration, used for all runs.
+            ao_buffer_cache: AoBufferCache for armed profiles, repeated steps are armed once anyway.
+            stages: Extra stages for every run, e.g. a live preview.
+        """
+        self._daq_device_handler = daq_device_handler
+        self._settings_parser = settings_parser
+        self._calibration = calibration
+        self._ao_buffer_cache = ao_buffer_cache
+        self._stages = stages if stages is not None else []
+        # one flag for the sequence and all its runs, set by abort before, during or between runs
+        self._abort_event = threading.Event()
+        self._fh: Optional[FastHeat] = None
+        self._run_index = 0
+        self._runs_num = 0
+
+    def run(self, steps: List[SequenceStep], path: Optional[str] = None) -> str:
+        """Runs all steps.
+
+        Args:
+            steps: Profiles with their repeats and delays.
+            path: A string path to the results HDF5 file, a new file in the sequences folder by default.
+
+        Returns:
+            The path to the results file.
+        """
+        self._run_index = 0
+        self._runs_num = sum(step.repeats for step in steps)
+
+        # arming all profiles first, so there are no computations between runs
+        fast_heats = []
+        for step in steps:
+            fh = FastHeat(self._daq_device_handler, self._settings_parser, step.time_temp_table,
+                          self._calibration, self._ao_buffer_cache, self._abort_event)
+            for stage in self._stages:
+                fh.add_stage(stage)
+            fh.arm()
+            fast_heats.append(fh)
+
+        if path is None:
+            if not os.path.exists(SEQUENCE_FOLDER_REL_PATH):
+                os.makedirs(SEQUENCE_FOLDER_REL_PATH)
+            path = os.path.join(SEQUENCE_FOLDER_REL_PATH, time.strftime(SEQUENCE_FILE_FORMAT))
+        logging.info("SEQUENCE: {} runs of {} profiles are written to {}.".format(self._runs_num, len(steps), path))
+
+        em = ExperimentManager(self._daq_device_handler, dict(), self._settings_parser,
+                               abort_event=self._abort_event)
+        with tables.open_file(path, mode='w') as results_file, em:
+            for step_index, (step, fh) in enumerate(zip(steps, fast_heats)):
+                for repeat in range(step.repeats):
+                    if self._abort_event.is_set():
+                        break
+                    em.reset_run()
+                    em.set_results_group(results_file, SEQUENCE_RUN_GROUP.format(self._run_index))
+                    em.add_run_attrs(step=step_index, repeat=repeat, start_time=time.time(),
+                                     profile_time=np.asarray(step.time_temp_table['time'], dtype=float),
+                                     profile_temperature=np.asarray(step.time_temp_table['temperature'],
+                                                                    dtype=float))
+                    self._fh = fh
+                    fh.run(em)
+                    if self._abort_event.is_set():
+                        break
+                    self._run_index += 1
+                    if step.delay > 0 and self._run_index < self._runs_num:
+                        self._abort_event.wait(step.delay)
+
+        if self._abort_event.is_set():
+            logging.warning("SEQUENCE: WARNING. Sequence aborted after {} of {} runs.".format(self._run_index,
+                                                                                           self._runs_num))
+        return path
+
+    def abort(self):
+        """Stops the current run and skips the rest of the sequence, can be called from any thread.
+
+        An abort requested while the profiles are armed or between runs is kept, no further run is started.
+        The sequencer stays aborted, a new one is needed for the next sequence.
+        """
+        logging.warning("SEQUENCE: WARNING. Sequence abort requested.")
+        self._abort_event.set()
+
+    def is_aborted(self) -> bool:
+        return self._abort_event.is_set()
+
+    def get_metrics(self) -> dict:
+        """Provides metrics of the current or the last run, see ExperimentManager.get_metrics."""
+        return self._fh.get_metrics() if self._fh is not None else dict()
+
+    def get_progress(self) -> dict:
+        """Provides the number of finished and all runs and the progress of the current run."""
+        progress = self._fh.get_progress() if self._fh is not None else \
+            dict(buffer_index=0, buffers_num=0, data_rate=0., finishing=False)
+        progress.update(run_index=self._run_index, runs_num=self._runs_num)
+        return progress
@@ -3,6 +3,7 @@ import json
 from daq_device import DaqParams
 from ai_device import AiParams
 from ao_device import AoParams
+from raw_data_store import StorageParams, get_available_compressions
 from utils import is_int_or_raise, list_bitwise_or
 from constants import *
 
@@ -62,6 +63,7 @@ class SettingsParser:
         self._parse_daq_params()
         self._parse_ai_params()
         self._parse_ao_params()
+        self._parse_storage_params()
         self._check_invalid_fields()
 
     def get_daq_params(self) -> DaqParams:
@@ -76,11 +78,22 @@ class SettingsParser:
         """Provides explicit access to the read AoParams."""
         return self._ao_params
 
+    def get_storage_params(self) -> StorageParams:
+        """Provides explicit access to the read StorageParams."""
+        return self._storage_params
+
     def _parse_daq_params(self):
         """Parses all necessary DAQ parameters and fills DaqParams instance."""
         self._daq_params = DaqParams()
         daq_dict = self._settings_dict[DAQ_FIELD]
 
+        if BACKEND_FIELD in daq_dict:  # optional, real board by default
+            backend = daq_dict[BACKEND_FIELD]
+            if backend not in DAQ_BACKENDS:
+                raise ValueError("'{}' is not a valid DAQ backend, use one of: {}.".format(backend,
+                                                                                         ", ".join(DAQ_BACKENDS)))
+            self._daq_params.backend = backend
+
         if INTERFACE_TYPE_FIELD in daq_dict:
             interface_types = daq_dict[INTERFACE_TYPE_FIELD]
             if isinstance(interface_types, list):
@@ -146,6 +159,21 @@ class SettingsParser:
         else:
             self._invalid_fields.append(SCAN_FLAGS_FIELD)
 
+        if WAIT_MODE_FIELD in ai_dict:  # optional, events by default
+            wait_mode = ai_dict[WAIT_MODE_FIELD]
+            if wait_mode not in WAIT_MODES:
+                raise ValueError("'{}' is not a valid AI wait mode, use one of: {}.".format(wait_mode,
+                                                                                         ", ".join(WAIT_MODES)))
+            self._ai_params.wait_mode = wait_mode
+
+        if BUFFER_TIME_FIELD in ai_dict:  # optional, 1 s by default
+            buffer_time = ai_dict[BUFFER_TIME_FIELD]
+            if buffer_time != AUTO_BUFFER_TIME and (isinstance(buffer_time, bool) or
+                                                    not isinstance(buffer_time, (int, float)) or buffer_time <= 0):
+                raise ValueError("'{}' is not a valid AI buffer time, use a positive number or '{}'.".format(
+                    buffer_time, AUTO_BUFFER_TIME))
+            self._ai_params.buffer_time = buffer_time if buffer_time == AUTO_BUFFER_TIME else float(buffer_time)
+
     def _parse_ao_params(self):
         """Parses all necessary analog-output parameters and fills AoParams instance."""
         self._ao_params = AoParams()
@@ -188,6 +216,54 @@ class SettingsParser:
         else:
             self._invalid_fields.append(SCAN_FLAGS_FIELD)
 
+        if STREAM_BUFFER_FIELD in ao_dict:  # optional, whole profile in one buffer by default
+            stream_buffer = ao_dict[STREAM_BUFFER_FIELD]
+            if isinstance(stream_buffer, bool) or not isinstance(stream_buffer, (int, float)) or stream_buffer < 0:
+                raise ValueError("'{}' is not a valid AO stream buffer length.".format(stream_buffer))
+            self._ao_params.stream_buffer = float(stream_buffer)
+
+        if TEMPERATURE_CONVERSION_FIELD in ao_dict:  # optional, lookup table by default
+            conversion = ao_dict[TEMPERATURE_CONVERSION_FIELD]
+            if conversion not in CONVERSION_MODES:
+                raise ValueError("'{}' is not a valid temperature conversion, use one of: {}.".format(
+                    conversion, ", ".join(CONVERSION_MODES)))
+            self._ao_params.temperature_conversion = conversion
+
+    def _parse_storage_params(self):
+        """Parses optional storage parameters and fills StorageParams instance, no compression by default."""
+        self._storage_params = StorageParams()
+        storage_dict = self._settings_dict.get(STORAGE_FIELD, dict())
+
+        if COMPRESSION_FIELD in storage_dict:
+            compression = storage_dict[COMPRESSION_FIELD]
+            available_compressions = get_available_compressions()
+            if compression != NO_COMPRESSION and compression not in available_compressions:
+                raise ValueError("'{}' is not an available compression, use one of: {}.".format(
+                    compression, ", ".join([NO_COMPRESSION] + available_compressions)))
+            self._storage_params.compression = compression
+
+        if COMPRESSION_LEVEL_FIELD in storage_dict:
+            compression_level = storage_dict[COMPRESSION_LEVEL_FIELD]
+            if is_int_or_raise(compression_level) and not 0 <= int(compression_level) <= 9:
+                raise ValueError("'{}' is not a valid compression level, use 0 - 9.".format(compression_level))
+            self._storage_params.compression_level = int(compression_level)
+
+        if SHUFFLE_FIELD in storage_dict:
+            shuffle = storage_dict[SHUFFLE_FIELD]
+            if shuffle not in SHUFFLE_MODES:
+                raise ValueError("'{}' is not a valid shuffle, use one of: {}.".format(shuffle,
+                                                                                    ", ".join(SHUFFLE_MODES)))
+            if shuffle == BIT_SHUFFLE and not self._storage_params.compression.startswith('blosc'):
+                raise ValueError("'{}' shuffle is supported only by blosc compressions.".format(shuffle))
+            self._storage_params.shuffle = shuffle
+
+        if KEEP_RAW_DATA_FIELD in storage_dict:  # optional, raw data is stored by default
+            keep_raw_data = storage_dict[KEEP_RAW_DATA_FIELD]
+            if not isinstance(keep_raw_data, bool):
+                raise ValueError("'{}' is not a valid {} value, use true or false.".format(keep_raw_data,
+                                                                                         KEEP_RAW_DATA_FIELD))
+            self._storage_params.keep_raw_data = keep_raw_data
+
     def _check_invalid_fields(self):
         """Raises ValueError if at least one required field is missing in the settings."""
         if self._invalid_fields:
@@ -0,0 +1,346 @@
+from typing import Callable, List, Tuple
+from ctypes import Array
+import threading
+import logging
+import time
+
+import numpy as np
+import uldaq as ul
+
+from ai_device import get_range_limits
+
+SIM_AI_CHANNELS_NUM = 8
+SIM_AI_RESOLUTION = 16  # bits
+SIM_AO_CHANNELS_NUM = 4
+SIM_TICK = 0.001  # s, how often the simulated board moves data into the buffer
+SIM_NOISE_LEN = 1 << 16
+SIM_NOISE_LEVEL = 1e-4  # V
+
+# calorimeter model used for synthetic signals (see FastHeat._apply_calibration for the channel meaning)
+SIM_SHUNT_RATIO = 0.37  # ch0, current-sense voltage relative to the heater voltage, gives R heater ~ 1.7 kOhm
+SIM_TPL_GAIN = 0.11  # ch4, amplified thermopile voltage per squared heater volt
+SIM_AUX_VOLTAGE = 0.25  # ch3, AD595 output, 10 mV/C -> 25 C
+
+
+class SimAiInfo:
+    def has_pacer(self) -> bool:
+        return True
+
+    def get_num_chans_by_mode(self, input_mode: ul.AiInputMode) -> int:
+        return SIM_AI_CHANNELS_NUM
+
+    def get_resolution(self) -> int:
+        return SIM_AI_RESOLUTION
+
+
+class SimAoInfo:
+    def has_pacer(self) -> bool:
+        return True
+
+    def get_num_chans(self) -> int:
+        return SIM_AO_CHANNELS_NUM
+
+
+class SimDaqDeviceInfo:
+    def get_event_types(self) -> List[ul.DaqEventType]:
+        return [ul.DaqEventType.ON_DATA_AVAILABLE, ul.DaqEventType.ON_END_OF_INPUT_SCAN,
+                ul.DaqEventType.ON_INPUT_SCAN_ERROR]
+
+
+class _SimScan:
+    """Keeps the timing of one simulated hardware-paced scan."""
+
+    def __init__(self, low_channel: int, high_channel: int, rate: float,
+                 samples_per_channel: int, options: ul.ScanOption, buffer: Array[float]):
+        self.low_channel = low_channel
+        self.channels_num = high_channel - low_channel + 1
+        self.rate = rate
+        self.samples_per_channel = samples_per_channel
+        self.is_continuous = bool(options & ul.ScanOption.CONTINUOUS)
+        self.buffer = np.ctypeslib.as_array(buffer).reshape(-1, self.channels_num)
+        self.start_time = time.perf_counter()
+        self.stop_count = None
+
+    def count(self) -> int:
+        """Number of scans (samples per channel) made since start."""
+        if self.stop_count is not None:
+            return self.stop_count
+        count = int((time.perf_counter() - self.start_time) * self.rate)
+        if not self.is_continuous:
+            count = min(count, self.samples_per_channel)
+        return count
+
+    def is_running(self) -> bool:
+        return self.stop_count is None and (self.is_continuous or self.count() < self.samples_per_channel)
+
+    def stop(self):
+        if self.stop_count is None:
+            self.stop_count = self.count()
+
+    def transfer_status(self, count: int) -> ul.TransferStatus:
+        status = ul.TransferStatus()
+        status._current_scan_count = count
+        status._current_total_count = count * self.channels_num
+        # index of the first sample of the last transferred scan, -1 before the first one
+        status._current_index = ((count - 1) % self.samples_per_channel) * self.channels_num if count else -1
+        return status
+
+
+class SimAoDevice:
+    """Simulated analog output, stands for uldaq.AoDevice."""
+
+    def __init__(self):
+        self._scan = None
+        self._values = np.zeros(SIM_AO_CHANNELS_NUM)
+
+    def get_info(self) -> SimAoInfo:
+        return SimAoInfo()
+
+    def a_out(self, channel: int, analog_range: ul.Range, flags: ul.AOutFlag, data: float):
+        # like the real board, single outputs are refused while a scan is running
+        if self._scan is not None and self._scan.is_running():
+            raise ul.ULException(ul.ULError.ALREADY_ACTIVE)
+        self._values[channel] = data
+
+    def a_out_scan(self, low_channel: int, high_channel: int, analog_range: ul.Range, samples_per_channel: int,
+                   rate: float, options: ul.ScanOption, flags: ul.AOutScanFlag, data: Array[float]) -> float:
+        self.scan_stop()
+        self._scan = _SimScan(low_channel, high_channel, rate, samples_per_channel, options, data)
+        return rate
+
+    def get_scan_status(self) -> Tuple[ul.ScanStatus, ul.TransferStatus]:
+        if self._scan is None:
+            return ul.ScanStatus.IDLE, ul.TransferStatus()
+        status = ul.ScanStatus.RUNNING if self._scan.is_running() else ul.ScanStatus.IDLE
+        return status, self._scan.transfer_status(self._scan.count())
+
+    def scan_stop(self):
+        if self._scan is not None and self._scan.is_running():
+            self._scan.stop()
+            # like the real board, the outputs keep the last written values
+            last = max(self._scan.count() - 1, 0) % self._scan.samples_per_channel
+            channels = slice(self._scan.low_channel, self._scan.low_channel + self._scan.channels_num)
+            self._values[channels] = self._scan.buffer[last]
+
+    def get_output(self, channel: int, times: np.ndarray) -> np.ndarray:
+        """Returns voltages on the given channel at the given times (s, relative to the current scan start)."""
+        scan = self._scan
+        position = channel - scan.low_channel if scan is not None else -1
+        if position < 0 or position >= scan.channels_num:
+            return np.full(len(times), self._values[channel])
+
+        indices = (times * scan.rate).astype(np.int64)
+        if scan.is_continuous:
+            indices %= scan.samples_per_channel
+        else:
+            np.clip(indices, 0, scan.samples_per_channel - 1, out=indices)
+        if scan.stop_count is not None:
+            indices[indices >= scan.stop_count] = max(scan.stop_count - 1, 0) % scan.samples_per_channel
+        return scan.buffer[indices, position]
+
+
+class SimAiDevice:
+    """Simulated analog input, stands for uldaq.AiDevice.
+
+    A background thread advances the scan in real time at the requested rate and writes
+    synthetic calorimeter signals into the circular buffer, following the simulated AO outputs.
+    """
+
+    def __init__(self, ao_device: SimAoDevice):
+        self._ao_device = ao_device
+        self._scan = None
+        self._counts_range = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._produced = 0
+        self._events = dict()  # event type -> (event parameter, callback, user data)
+        self._noise = np.random.default_rng(0).normal(0., SIM_NOISE_LEVEL, SIM_NOISE_LEN)
+
+    def get_info(self) -> SimAiInfo:
+        return SimAiInfo()
+
+    def a_in_scan(self, low_channel: int, high_channel: int, input_mode: ul.AiInputMode, analog_range: ul.Range,
+                  samples_per_channel: int, rate: float, options: ul.ScanOption, flags: ul.AInScanFlag,
+                  data: Array[float]) -> float:
+        self.scan_stop()
+        self._scan = _SimScan(low_channel, high_channel, rate, samples_per_channel, options, data)
+        # like the real board, the NOSCALEDATA flag gives ADC counts of the range instead of volts
+        self._counts_range = get_range_limits(analog_range) if flags & ul.AInScanFlag.NOSCALEDATA else None
+        self._produced = 0
+        self._thread = threading.Thread(target=self._acquire, name="SimAiScan", daemon=True)
+        self._thread.start()
+        return rate
+
+    def get_scan_status(self) -> Tuple[ul.ScanStatus, ul.TransferStatus]:
+        if self._scan is None:
+            return ul.ScanStatus.IDLE, ul.TransferStatus()
+        with self._lock:
+            produced = self._produced
+        status = ul.ScanStatus.RUNNING if self._scan.is_running() else ul.ScanStatus.IDLE
+        return status, self._scan.transfer_status(produced)
+
+    def scan_stop(self):
+        if self._scan is not None:
+            self._scan.stop()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _acquire(self):
+        scan = self._scan
+        while scan.is_running():
+            target = scan.count()
+            if target > self._produced:
+                self._fill(scan, self._produced, target)
+                with self._lock:
+                    produced, self._produced = self._produced, target
+                if ul.DaqEventType.ON_DATA_AVAILABLE in self._events:
+                    samples_per_event = self._events[ul.DaqEventType.ON_DATA_AVAILABLE][0]
+                    if target // samples_per_event > produced // samples_per_event:
+                        self._notify(ul.DaqEventType.ON_DATA_AVAILABLE, target)
+            time.sleep(SIM_TICK)
+        logging.info("SIM DEVICE: AI scan stopped after {} samples per channel.".format(self._produced))
+        self._notify(ul.DaqEventType.ON_END_OF_INPUT_SCAN, self._produced)
+
+    def enable_event(self, event_type: ul.DaqEventType, event_parameter: int,
+                     event_callback_function: Callable[[ul.EventCallbackArgs], None], user_data: object):
+        self._events[event_type] = (event_parameter, event_callback_function, user_data)
+
+    def disable_event(self, event_type: ul.DaqEventType):
+        self._events.pop(event_type, None)
+
+    def _notify(self, event_type: ul.DaqEventType, event_data: int):
+        if event_type in self._events:
+            _, callback, user_data = self._events[event_type]
+            callback(ul.EventCallbackArgs(event_type, event_data, user_data))
+
+    def _fill(self, scan: _SimScan, start: int, stop: int):
+        samples = np.arange(start, stop)
+        times = samples / scan.rate
+        block = self._signals(scan, samples, times)
+        if self._counts_range is not None:
+            low, high = self._counts_range
+            block = np.clip(np.round((block - low) * (2 ** SIM_AI_RESOLUTION / (high - low))),
+                            0, 2 ** SIM_AI_RESOLUTION - 1)
+
+        # writing into the circular buffer, splitting the block on wrap-around
+        first = start % scan.samples_per_channel
+        head = min(len(block), scan.samples_per_channel - first)
+        scan.buffer[first:first + head] = block[:head]
+        if head < len(block):
+            scan.buffer[:len(block) - head] = block[head:]
+
+    def _signals(self, scan: _SimScan, samples: np.ndarray, times: np.ndarray) -> np.ndarray:
+        heater = self._ao_device.get_output(1, times)
+        modulation = self._ao_device.get_output(0, times)
+
+        channels = np.empty((SIM_AI_CHANNELS_NUM, len(samples)))
+        channels[0] = heater * SIM_SHUNT_RATIO
+        channels[1] = modulation * 0.121
+        channels[2] = 0.
+        channels[3] = SIM_AUX_VOLTAGE
+        channels[4] = heater * heater * SIM_TPL_GAIN
+        channels[5] = heater
+        channels[6:] = 0.
+        channels += self._noise[samples % SIM_NOISE_LEN]
+
+        return channels[scan.low_channel:scan.low_channel + scan.channels_num].T
+
+
+class SimDaqDeviceDescriptor:
+    def __init__(self):
+        self.product_name = "SIM-DAQ"
+        self.dev_string = "Simulated DAQ device"
+        self.dev_interface = ul.InterfaceType.ANY
+        self.unique_id = "sim"
+
+
+class SimDaqDevice:
+    """Simulated DAQ board, stands for uldaq.DaqDevice."""
+
+    def __init__(self):
+        self._is_connected = False
+        self._ao_device = SimAoDevice()
+        self._ai_device = SimAiDevice(self._ao_device)
+
+    def get_descriptor(self) -> SimDaqDeviceDescriptor:
+        return SimDaqDeviceDescriptor()
+
+    def get_info(self) -> SimDaqDeviceInfo:
+        return SimDaqDeviceInfo()
+
+    def enable_event(self, event_types: ul.DaqEventType, event_parameter: int,
+                     event_callback_function: Callable[[ul.EventCallbackArgs], None], user_data: object):
+        for event_type in SimDaqDeviceInfo().get_event_types():
+            if event_types & event_type:
+                self._ai_device.enable_event(event_type, event_parameter, event_callback_function, user_data)
+
+    def disable_event(self, event_types: ul.DaqEventType):
+        for event_type in SimDaqDeviceInfo().get_event_types():
+            if event_types & event_type:
+                self._ai_device.disable_event(event_type)
+
+    def connect(self, connection_code: int = 0):
+        self._is_connected = True
+
+    def is_connected(self) -> bool:
+        return self._is_connected
+
+    def disconnect(self):
+        self._ai_device.scan_stop()
+        self._ao_device.scan_stop()
+        self._is_connected = False
+
+    def release(self):
+        self.disconnect()
+
+    def reset(self):
+        self.disconnect()
+
+    def get_ai_device(self) -> SimAiDevice:
+        return self._ai_device
+
+    def get_ao_device(self) -> SimAoDevice:
+        return self._ao_device
+
+
+if __name__ == '__main__':
+    # Runs acquisitions on the simulated board with every AI wait mode, to check that the read loop keeps up
+    # with the sample rate and to compare CPU usage and wake-up latency of the modes.
+    # usage: python sim_device.py [ai_sample_rate] [duration_s]
+    import sys
+    import os
+    from daq_device import DaqDeviceHandler
+    from experiment_manager import ExperimentManager
+    from settings import SettingsParser
+    from constants import (SETTINGS_PATH, SIMULATED_BACKEND, MAX_SCAN_SAMPLE_RATE, RAW_DATA_FOLDER_REL_PATH,
+                           WAIT_MODES)
+
+    logging.basicConfig(level=logging.WARNING)
+    _ai_rate = min(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, MAX_SCAN_SAMPLE_RATE)
+    _duration = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    _parser = SettingsParser(SETTINGS_PATH)
+    _parser.get_daq_params().backend = SIMULATED_BACKEND
+    _parser.get_ai_params().sample_rate = _ai_rate
+    _ao_rate = _parser.get_ao_params().sample_rate
+    _profiles = {'ch1': np.linspace(0., 5., _duration * _ao_rate)}
+    os.makedirs(RAW_DATA_FOLDER_REL_PATH, exist_ok=True)
+
+    _daq_device_handler = DaqDeviceHandler(_parser.get_daq_params())
+    _daq_device_handler.connect()
+    for _wait_mode in WAIT_MODES:
+        _parser.get_ai_params().wait_mode = _wait_mode
+        with ExperimentManager(_daq_device_handler, _profiles, _parser) as _em:
+            _start, _cpu_start = time.perf_counter(), time.process_time()
+            _em.run()
+            _elapsed, _cpu = time.perf_counter() - _start, time.process_time() - _cpu_start
+            _ai_channels = _parser.get_ai_params()
+            _data = _em.get_ai_data(list(range(_ai_channels.high_channel - _ai_channels.low_channel + 1)))
+            _wait_metrics = _em.get_metrics()['read_loop']
+
+        print("{:>5}: AI rate {} Hz, acquired {} of {} samples per channel in {:.2f} s (profile {} s), "
+              "CPU {:.0f}%, {} wake-ups, flip latency mean {:.2f} ms, max {:.2f} ms".format(
+                  _wait_mode, _ai_rate, len(_data), _ai_rate * _duration, _elapsed, _duration,
+                  100. * _cpu / _elapsed, _wait_metrics['wakeups'],
+                  1e3 * _wait_metrics['mean_flip_latency'], 1e3 * _wait_metrics['max_flip_latency']))
@@ -1,75 +1,187 @@
-from calibration import Calibration
-
-from typing import List
-from bisect import bisect_left
-import numpy as np
-
-
-def is_int(key) -> bool:
-    if isinstance(key, int) or isinstance(key, str) and key.isdigit():
-        return True
-
-
-def is_int_or_raise(key) -> bool:
-    if is_int(key):
-        return True
-    raise ValueError("'{}' is not an integer value.".format(key))
-
-
-def list_bitwise_or(ints: List[int]) -> int:
-    res = 0
-    for i in ints:
-        res |= i
-    return res
-
-# calorimeter utils
-# ====================================================
-def voltage_to_temperature(voltage: np.array, calibration: Calibration) -> np.array:
-    volt = voltage.copy()
-    volt[volt < 0] = 0
-    volt[volt > calibration.safe_voltage] = calibration.safe_voltage
-    temp = calibration.theater0 * volt + calibration.theater1 * (volt**2) + calibration.theater2 * (volt**3)
-    return temp
-
-
-# TODO: think maybe to create a T-V (and vice versa) converter class
-def temperature_to_voltage(temp: np.array, calibration:  Calibration) -> np.array:
-    # generating temp-volt dependency in full calibration range
-    resolution = 0.0001  # V
-    volt_calib = np.linspace(0, calibration.safe_voltage, int(1 / resolution))
-
-    temp_calib = voltage_to_temperature(volt_calib, calibration)
-    temp_calib[temp_calib <= calibration.min_temp] = calibration.min_temp
-    temp_calib[temp_calib >= calibration.max_temp] = calibration.max_temp
-
-    voltage = np.zeros(len(temp))
-    for i, t in np.ndenumerate(temp):
-        idx = bisect_left(temp_calib, t)
-        voltage[i] = volt_calib[idx]
-
-    return voltage.round(4)
-
-
-if __name__ == '__main__':
-
-    # import matplotlib.pyplot as plt
-    from time import time
-
-    temp_exp_1 = np.zeros(1000) - 1
-    temp_exp_2 = np.linspace(-1, 300, 3000)
-    temp_exp_3 = np.ones(1000) + 299
-    temp_exp_4 = np.linspace(300, -2, 3000)
-    temp_exp_5 = np.zeros(1000) - 2
-    temp_exp = np.concatenate((temp_exp_1, temp_exp_2, temp_exp_3, temp_exp_4, temp_exp_5))
-    # plt.plot(temp_exp)
-    # plt.show()
-
-    t1 = time()
-    volt_exp = temperature_to_voltage(temp_exp, Calibration())
-    t2 = time()
-    print(t2 - t1)
-    print(volt_exp[1000:1100])
-    # plt.plot(temp_exp, label = 'temp_exp')
-    # plt.plot(volt_exp, label = 'volt_exp')
-    # plt.legend()
-    # plt.show()
\ No newline at end of file
+from calibration import Calibration
+from constants import LOOKUP_CONVERSION, NEWTON_CONVERSION, CONVERSION_MODES
+
+from typing import List, Tuple
+from functools import lru_cache
+import numpy as np
+import logging
+
+
+def is_int(key) -> bool:
+    if isinstance(key, int) or isinstance(key, str) and key.isdigit():
+        return True
+
+
+def is_int_or_raise(key) -> bool:
+    if is_int(key):
+        return True
+    raise ValueError("'{}' is not an integer value.".format(key))
+
+
+def list_bitwise_or(ints: List[int]) -> int:
+    res = 0
+    for i in ints:
+        res |= i
+    return res
+
+
+def deinterleave(data: np.ndarray, channels_num: int) -> np.ndarray:
+    """Turns an interleaved stream [ch0, ch1, ..., ch0, ch1, ...] into a (samples, channels) view without copy."""
+    return data.reshape(-1, channels_num)
+
+# calorimeter utils
+# ====================================================
+def voltage_to_temperature(voltage: np.array, calibration: Calibration) -> np.array:
+    volt = voltage.copy()
+    volt[volt < 0] = 0
+    volt[volt > calibration.safe_voltage] = calibration.safe_voltage
+    temp = calibration.theater0 * volt + calibration.theater1 * (volt**2) + calibration.theater2 * (volt**3)
+    return temp
+
+
+CALIBRATION_TABLE_POINTS = 10000
+NEWTON_GUESS_POINTS = 64
+NEWTON_TOLERANCE = 1e-6  # C
+NEWTON_MAX_ITERATIONS = 20
+
+
+@lru_cache(maxsize=8)
+def _get_calibration_table(theater0: float, theater1: float, theater2: float, safe_voltage: float,
+                           min_temp: float, max_temp: float) -> Tuple[np.ndarray, np.ndarray]:
+    # generating temp-volt dependency in full calibration range
+    volt_calib = np.linspace(0, safe_voltage, CALIBRATION_TABLE_POINTS)
+    temp_calib = theater0 * volt_calib + theater1 * (volt_calib ** 2) + theater2 * (volt_calib ** 3)
+    np.clip(temp_calib, min_temp, max_temp, out=temp_calib)
+    volt_calib.flags.writeable = False
+    temp_calib.flags.writeable = False
+    return temp_calib, volt_calib
+
+
+@lru_cache(maxsize=8)
+def _get_monotonic_table(theater0: float, theater1: float, theater2: float,
+                          safe_voltage: float) -> Tuple[np.ndarray, np.ndarray]:
+    # voltage range within [0, safe_voltage] where Theater(U) grows, bounded by the critical points
+    # of the cubic: dT/dU = theater0 + 2 * theater1 * U + 3 * theater2 * U^2 = 0
+    volt_low, volt_high = 0., safe_voltage
+    roots = np.roots([3 * theater2, 2 * theater1, theater0])
+    for root in sorted(r.real for r in roots if abs(r.imag) < 1e-12 and 0. < r.real < safe_voltage):
+        if theater1 + 3 * theater2 * root > 0:  # second derivative > 0, local minimum
+            volt_low = root
+        else:
+            volt_high = root
+            break
+
+    # coarse table inside the region for the initial guess of Newton iterations
+    volt_guess = np.linspace(volt_low, volt_high, NEWTON_GUESS_POINTS)
+    temp_guess = theater0 * volt_guess + theater1 * (volt_guess ** 2) + theater2 * (volt_guess ** 3)
+    volt_guess.flags.writeable = False
+    temp_guess.flags.writeable = False
+    return temp_guess, volt_guess
+
+
+class TemperatureVoltageConverter:
+    """Converts heater temperatures to voltages with the heater calibration (Theater).
+
+    In the lookup mode the T-V table is built once per set of heater coefficients and safe voltage and
+    shared between converters, so it follows calibration changes and costs nothing for repeated profiles.
+    In the Newton mode the cubic is inverted exactly on its growing region with vectorized Newton iterations.
+    """
+
+    def __init__(self, calibration: Calibration, interpolate: bool = False,
+                 mode: str = LOOKUP_CONVERSION, tolerance: float = NEWTON_TOLERANCE):
+        """Binds the converter to the calibration.
+
+        Args:
+            calibration: Calibration, read at every conversion, so the converter follows its changes.
+            interpolate: Lookup mode only. If True, interpolates linearly between table points,
+                otherwise takes the left bin.
+            mode: LOOKUP_CONVERSION or NEWTON_CONVERSION.
+            tolerance: Newton mode only. Maximal temperature error (C) of the result.
+
+        Raises:
+            ValueError if the mode is unknown.
+        """
+        if mode not in CONVERSION_MODES:
+            raise ValueError("'{}' is not a valid temperature to voltage conversion mode.".format(mode))
+        self._calibration = calibration
+        self._interpolate = interpolate
+        self._mode = mode
+        self._tolerance = tolerance
+
+    def get_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns read-only temperature and voltage arrays of the calibration table."""
+        return _get_calibration_table(self._calibration.theater0, self._calibration.theater1,
+                                      self._calibration.theater2, self._calibration.safe_voltage,
+                                      self._calibration.min_temp, self._calibration.max_temp)
+
+    def temperature_to_voltage(self, temp: np.array) -> np.array:
+        temp = np.asarray(temp, dtype=float)
+        if self._mode == NEWTON_CONVERSION:
+            return self._invert_polynomial(temp)
+
+        temp_calib, volt_calib = self.get_table()
+        if self._interpolate:
+            voltage = np.interp(temp, temp_calib, volt_calib)
+            voltage[temp <= temp_calib[0]] = volt_calib[0]  # the first point of the clipped region
+        else:
+            idx = np.searchsorted(temp_calib, temp, side='left')
+            voltage = volt_calib[np.minimum(idx, len(volt_calib) - 1)]
+        return voltage.round(4)
+
+    def _invert_polynomial(self, temp: np.ndarray) -> np.ndarray:
+        theater0, theater1, theater2 = self._calibration.theater0, self._calibration.theater1, \
+                                       self._calibration.theater2
+        temp_guess, volt_guess = _get_monotonic_table(theater0, theater1, theater2,
+                                                       self._calibration.safe_voltage)
+        target = np.clip(temp, max(temp_guess[0], self._calibration.min_temp),
+                         min(temp_guess[-1], self._calibration.max_temp))
+
+        voltage = np.interp(target, temp_guess, volt_guess)
+        for _ in range(NEWTON_MAX_ITERATIONS):
+            residual = ((theater2 * voltage + theater1) * voltage + theater0) * voltage - target
+            if not np.any(np.abs(residual) > self._tolerance):
+                break
+            slope = (3 * theater2 * voltage + 2 * theater1) * voltage + theater0
+            voltage -= residual / np.maximum(slope, 1e-12)  # slope is >= 0 in the region
+            np.clip(voltage, volt_guess[0], volt_guess[-1], out=voltage)
+        else:
+            logging.warning("WARNING. Temperature to voltage conversion didn't reach the tolerance "
+                            "of {} C, residual is {} C.".format(self._tolerance, np.abs(residual).max()))
+
+        voltage[temp <= self._calibration.min_temp] = 0.  # heater is off, like the left bin of the table
+        return voltage
+
+
+def temperature_to_voltage(temp: np.array, calibration:  Calibration) -> np.array:
+    return TemperatureVoltageConverter(calibration).temperature_to_voltage(temp)
+
+
+if __name__ == '__main__':
+    # Benchmark of temperature to voltage conversion modes: speed and temperature error of the result.
+    # usage: python utils.py [points_num]
+    import sys
+    import os
+    from time import perf_counter
+    from constants import CALIBRATION_PATH
+
+    _points_num = int(sys.argv[1]) if len(sys.argv) > 1 else 1200000  # 60 s at 20 kHz
+    _calibration = Calibration()
+    if os.path.exists(CALIBRATION_PATH):
+        _calibration.read(CALIBRATION_PATH)
+
+    temp_exp = np.concatenate((np.zeros(_points_num // 10) - 1,
+                               np.linspace(-1, 300, _points_num * 4 // 10),
+                               np.linspace(300, -2, _points_num * 4 // 10),
+                               np.zeros(_points_num // 10) - 2))
+    _valid = (temp_exp > _calibration.min_temp) & (temp_exp < _calibration.max_temp)
+
+    for _name, _converter in [('lookup', TemperatureVoltageConverter(_calibration)),
+                              ('lookup, interpolated', TemperatureVoltageConverter(_calibration, interpolate=True)),
+                              ('newton', TemperatureVoltageConverter(_calibration, mode=NEWTON_CONVERSION))]:
+        _converter.temperature_to_voltage(temp_exp[:10])  # building cached tables
+        t1 = perf_counter()
+        volt_exp = _converter.temperature_to_voltage(temp_exp)
+        t2 = perf_counter()
+        _error = np.abs(voltage_to_temperature(volt_exp, _calibration) - temp_exp)[_valid]
+        print("{:>20}: {:.4f} s for {} points, temperature error max {:.2e} C, mean {:.2e} C".format(
+            _name, t2 - t1, len(temp_exp), _error.max(), _error.mean()))